@@ -1,5 +1,7 @@
 from .__version__ import __version__, __url__, __author__, __author_email__, __license__, __description__
 
+default_app_config = 'wechat.apps.WechatConfig'
+
 
 def get_version():
     return __version__
@@ -30,10 +30,16 @@ class ForwardMessageConfAdmin(admin.ModelAdmin):
     list_display = ['app', 'url']
 
 
+@admin.register(models.ForwardOutboxModel)
+class ForwardOutboxAdmin(admin.ModelAdmin):
+    list_display = ['app', 'msg_type', 'status', 'attempts', 'next_attempt_at', 'last_error', 'create_time']
+    list_filter = ['app', 'status']
+
+
 @admin.register(models.WxUserModel)
 class WxUserAdmin(admin.ModelAdmin):
-    list_display = ['puid', 'name', 'avatar_url', 'nick_name', 'user_name', 'remark_name', 'signature', 'sex',
-                    'province', 'city']
+    list_display = ['puid', 'name', 'avatar_url', 'avatar_status', 'nick_name', 'user_name', 'remark_name',
+                    'signature', 'sex', 'province', 'city']
 
     readonly_fields = list_display + ['friends']
 
@@ -49,7 +55,7 @@ class WxUserAdmin(admin.ModelAdmin):
 
 @admin.register(models.WxGroupModel)
 class WxGroupAdmin(admin.ModelAdmin):
-    list_display = ['puid', 'name', 'avatar_url', 'nick_name', 'user_name', 'owner']
+    list_display = ['puid', 'name', 'avatar_url', 'avatar_status', 'nick_name', 'user_name', 'owner']
     readonly_fields = list_display
 
     def avatar_url(self, row):
@@ -115,3 +121,15 @@ class CardMessageAdmin(admin.ModelAdmin):
         return url
 
     avatar_url.short_description = '头像'
+
+
+@admin.register(models.MediaBlob)
+class MediaBlobAdmin(admin.ModelAdmin):
+    list_display = ['name', 'size', 'ref_count', 'create_time']
+    readonly_fields = list_display
+
+
+@admin.register(models.MessageRouteModel)
+class MessageRouteAdmin(admin.ModelAdmin):
+    list_display = ['app', 'priority', 'msg_type', 'chat_kind', 'puid', 'action']
+    list_filter = ['app', 'action']
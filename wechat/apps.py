@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class WechatConfig(AppConfig):
     name = 'wechat'
+
+    def ready(self):
+        from . import signals  # noqa
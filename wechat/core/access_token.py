@@ -1,11 +1,17 @@
 from django.conf import settings
+from django.utils.module_loading import import_string
 
 from wechat.models import AppModel
 
 from django_redis import get_redis_connection
 
 from . import exception
+from .cache import LRUCache, invalidator
 
+import base64
+import hashlib
+import hmac
+import time
 import uuid
 
 
@@ -13,6 +19,28 @@ class AccessToken:
     model = AppModel
     expire_in = getattr(settings, 'ACCESS_TOKEN_EXPIRE_IN', 3600 * 2)
 
+    # 进程内的token缓存,命中时不需要访问redis和数据库
+    cache_enabled = getattr(settings, 'ACCESS_TOKEN_CACHE', False)
+    cache = LRUCache(maxsize=getattr(settings, 'ACCESS_TOKEN_CACHE_SIZE', 1024),
+                     ttl=getattr(settings, 'ACCESS_TOKEN_CACHE_TTL', 5))
+
+    # 签发和轮换在redis里原子执行,只需要一次往返
+    # KEYS[1]: 反向查询的key, KEYS[2]: 新token
+    # ARGV[1]: app_id, ARGV[2]: 有效期, ARGV[3]: 缓存失效通知的频道,为空时不通知
+    issue_script = """
+    local old = redis.call('GET', KEYS[1])
+    if old then
+        redis.call('DEL', old)
+        if ARGV[3] ~= '' then
+            redis.call('PUBLISH', ARGV[3], 'token:' .. old)
+        end
+    end
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+    redis.call('SET', KEYS[1], KEYS[2], 'EX', ARGV[2])
+    return old
+    """
+    _issue_script = None
+
     @classmethod
     def create_access_token(cls, app_id, app_secret):
         """创建token"""
@@ -22,47 +50,191 @@ class AccessToken:
 
         token = uuid.uuid4().__str__()
 
-        coon.set(token, app_id)
-
-        coon.expire(token, cls.expire_in)
-
+        # 创建反向的查询,即使生成了多个token也只会有唯一一个生效
         key = f'{app_id}_access_token'
 
-        # 把原来的旧的删掉,减少内存的占用
-        raw_token = coon.get(key)
+        channel = invalidator.channel if cls.cache_enabled else ''
+        # 把原来的旧的删掉,减少内存的占用,同时通知所有进程删除旧token的缓存
+        raw_token = cls.get_issue_script(coon)(keys=[key, token], args=[app_id, cls.expire_in, channel])
 
-        if raw_token:
-            coon.delete(raw_token)
-
-        # 创建反向的查询,即使生成了多个token也只会有唯一一个生效
-        coon.set(key, token)
-        coon.expire(key, cls.expire_in)
+        if raw_token and cls.cache_enabled:
+            invalidator.dispatch('token', raw_token.decode())
         return token
 
+    @classmethod
+    def get_issue_script(cls, coon):
+        """注册lua脚本,之后通过`EVALSHA`调用,`Script`对象只创建一次"""
+        if cls._issue_script is None:
+            cls._issue_script = coon.register_script(cls.issue_script)
+        return cls._issue_script
+
     @classmethod
     def check_access_token(cls, token):
         """检验token"""
+        if not cls.cache_enabled:
+            return cls._check_access_token(token)
+
+        app = cls.cache.get(token)
+        if app is None:
+            invalidator.start()
+            app = cls._check_access_token(token)
+            cls.cache.set(token, app)
+        return app
+
+    @classmethod
+    def _check_access_token(cls, token):
         coon = get_redis_connection('default')
         app_id = coon.get(token)
         if app_id:
 
             app_id = app_id.decode()
 
-            app = cls.get_model(app_id=app_id)
-
             # 获取真实的有效的token
-            real_token = coon.get(f'{app_id}_access_token').decode()
+            real_token = coon.get(f'{app_id}_access_token')
             # 检查当前的token和真实的token是否一致
-            if real_token == token:
-                return app
+            if real_token and real_token.decode() == token:
+                # 顺便把`bind`查出来,缓存后不会再触发懒加载
+                return cls.get_model(cls.model.objects.select_related('bind'), app_id=app_id)
 
         raise exception.InvalidTokenException()
 
     @classmethod
-    def get_model(cls, **kwargs):
+    def get_model(cls, queryset=None, **kwargs):
         """获取app模型"""
+        queryset = cls.model.objects.all() if queryset is None else queryset
         try:
-            app = cls.model.objects.get(**kwargs)
+            app = queryset.get(**kwargs)
         except cls.model.DoesNotExist:
             raise exception.AppDoesNotExistException()
         return app
+
+    @classmethod
+    def invalidate_token(cls, token):
+        cls.cache.pop(token)
+
+    @classmethod
+    def invalidate_app(cls, app_id):
+        """删除某个app的所有缓存,比如`bind`发生了变化"""
+        cls.cache.discard_if(lambda token, app: app.app_id == app_id)
+
+    @classmethod
+    def subscribe(cls):
+        """订阅其他进程发出的缓存失效通知"""
+        if cls.cache_enabled:
+            invalidator.subscribe('token', cls.invalidate_token)
+            invalidator.subscribe('app', cls.invalidate_app)
+
+
+class SignedAccessToken(AccessToken):
+    """自包含的签名token
+
+    token里包含`app_id`,过期时间和签发时app的吊销纪元(epoch),校验时只需要计算hmac,
+    纪元缓存在进程内,过期或者遇到更新的纪元时才会去redis里取,每次签发新的token都会让纪元加一,
+    所以同一个app仍然只有最新的token有效
+    """
+    sign_key = getattr(settings, 'ACCESS_TOKEN_SIGN_KEY', settings.SECRET_KEY).encode()
+
+    # app_id -> app
+    cache = LRUCache(maxsize=getattr(settings, 'ACCESS_TOKEN_CACHE_SIZE', 1024),
+                     ttl=getattr(settings, 'ACCESS_TOKEN_CACHE_TTL', 5))
+    # app_id -> 当前的吊销纪元
+    epochs = LRUCache(maxsize=getattr(settings, 'ACCESS_TOKEN_CACHE_SIZE', 1024),
+                      ttl=getattr(settings, 'ACCESS_TOKEN_EPOCH_TTL', 60))
+
+    @classmethod
+    def create_access_token(cls, app_id, app_secret):
+        """创建token"""
+        cls.get_model(app_id=app_id, app_secret=app_secret)
+        epoch = cls.revoke(app_id)
+        expire_at = int(time.time()) + cls.expire_in
+        return cls.sign(f'{app_id}:{expire_at}:{epoch}')
+
+    @classmethod
+    def check_access_token(cls, token):
+        """检验token"""
+        app_id, expire_at, epoch = cls.unsign(token)
+
+        if expire_at < time.time() or epoch != cls.get_epoch(app_id, epoch):
+            raise exception.InvalidTokenException()
+
+        app = cls.cache.get(app_id)
+        if app is None:
+            app = cls.get_model(cls.model.objects.select_related('bind'), app_id=app_id)
+            cls.cache.set(app_id, app)
+        return app
+
+    @classmethod
+    def revoke(cls, app_id):
+        """吊销app已经签发的所有token,返回新的纪元"""
+        coon = get_redis_connection('default')
+        epoch = coon.incr(cls.get_epoch_key(app_id))
+        cls.epochs.set(app_id, epoch)
+        coon.publish(invalidator.channel, f'epoch:{app_id}')
+        return epoch
+
+    @classmethod
+    def get_epoch(cls, app_id, epoch):
+        """获取app当前的纪元,token里的纪元更新时说明缓存已经过时了"""
+        current = cls.epochs.get(app_id)
+        if current is None or epoch > current:
+            invalidator.start()
+            coon = get_redis_connection('default')
+            current = int(coon.get(cls.get_epoch_key(app_id)) or 0)
+            cls.epochs.set(app_id, current)
+        return current
+
+    @staticmethod
+    def get_epoch_key(app_id):
+        return f'{app_id}_token_epoch'
+
+    @classmethod
+    def sign(cls, payload):
+        payload = payload.encode()
+        signature = hmac.new(cls.sign_key, payload, hashlib.sha256).digest()
+        return f'{cls.b64encode(payload)}.{cls.b64encode(signature)}'
+
+    @classmethod
+    def unsign(cls, token):
+        """验证签名,返回`(app_id, expire_at, epoch)`"""
+        try:
+            payload, signature = token.split('.')
+            payload, signature = cls.b64decode(payload), cls.b64decode(signature)
+        except ValueError:
+            raise exception.InvalidTokenException()
+
+        real_signature = hmac.new(cls.sign_key, payload, hashlib.sha256).digest()
+        if not hmac.compare_digest(real_signature, signature):
+            raise exception.InvalidTokenException()
+
+        app_id, expire_at, epoch = payload.decode().split(':')
+        return app_id, int(expire_at), int(epoch)
+
+    @staticmethod
+    def b64encode(value):
+        return base64.urlsafe_b64encode(value).rstrip(b'=').decode()
+
+    @staticmethod
+    def b64decode(value):
+        return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+    @classmethod
+    def invalidate_app(cls, app_id):
+        cls.cache.pop(app_id)
+
+    @classmethod
+    def invalidate_epoch(cls, app_id):
+        cls.epochs.pop(app_id)
+
+    @classmethod
+    def subscribe(cls):
+        invalidator.subscribe('app', cls.invalidate_app)
+        invalidator.subscribe('epoch', cls.invalidate_epoch)
+
+
+def get_access_token_class():
+    """获取settings里配置的token后端"""
+    return access_token_class
+
+
+access_token_class = import_string(getattr(settings, 'ACCESS_TOKEN_BACKEND', 'wechat.core.access_token.AccessToken'))
+access_token_class.subscribe()
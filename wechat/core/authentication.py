@@ -1,10 +1,13 @@
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 
-from wechat.core.access_token import AccessToken
+from wechat.core.access_token import get_access_token_class
+from wechat.core.metrics import METRICS
 from wechat.core import exception
 from wechat import serializers
 
+import hmac
+
 
 class SignatureAuthentication(BaseAuthentication):
 
@@ -24,8 +27,23 @@ class AccessTokenAuthentication(BaseAuthentication):
         access_token = request.GET.get('access_token')
         if access_token:
             try:
-                app = AccessToken.check_access_token(access_token)
+                app = get_access_token_class().check_access_token(access_token)
             except exception.InvalidTokenException:
                 raise AuthenticationFailed({'errmsg': '无效的token或已过期!'})
             return app.bind, app
         raise AuthenticationFailed({'errmsg': '无效的身份信息!'})
+
+
+class MetricsAuthentication(BaseAuthentication):
+    """`/metrics` 验证类,`METRICS`里配置的`allowed_ips`可以直接访问,其他地址需要带上`token`"""
+
+    def authenticate(self, request):
+        token = METRICS['token']
+        if token:
+            header = request.META.get('HTTP_AUTHORIZATION', '')
+            value = header[len('Bearer '):] if header.startswith('Bearer ') else request.GET.get('token', '')
+            if hmac.compare_digest(token.encode(), value.encode()):
+                return None, token
+        if request.META.get('REMOTE_ADDR') in METRICS['allowed_ips']:
+            return None, None
+        raise AuthenticationFailed({'errmsg': '无效的身份信息!'})
@@ -0,0 +1,131 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+from io import BytesIO
+
+from .const import AVATAR_PENDING, AVATAR_READY, AVATAR_FAILED
+from .metrics import metrics
+
+import queue
+import threading
+import time
+
+# workers为0时在创建联系人的时候直接下载头像
+AVATAR_FETCHER = {'workers': 2, 'maxsize': 5000, 'rate': 5, 'retries': 3, 'backoff': 2}
+AVATAR_FETCHER.update(getattr(settings, 'AVATAR_FETCHER', {}))
+
+
+class AvatarFetcher:
+    """后台下载联系人头像,限制并发数和每秒的请求数,失败后按指数退避重试"""
+
+    def __init__(self, workers=2, maxsize=5000, rate=5, retries=3, backoff=2):
+        self.workers = workers
+        self.interval = 1 / rate if rate else 0
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=maxsize)
+
+        self.fetched = 0
+        self.failed = 0
+        self.skipped = 0
+
+        self._next_time = 0
+        self._rate_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, obj, chat):
+        """`obj`为`WxUserModel`或`WxGroupModel`对象,`chat`为对应的wxpy对象"""
+        if not self.workers:
+            return self.fetch(obj, chat)
+        self.start()
+        try:
+            self.queue.put_nowait((obj, chat, 0))
+        except queue.Full:
+            # 队列满了就先放弃,头像保持获取中的状态
+            self.skipped += 1
+
+    def start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f'wechat-avatar-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def work(self):
+        while True:
+            obj, chat, attempt = self.queue.get()
+            self.throttle()
+            try:
+                self.fetch(obj, chat)
+            except Exception as e:
+                self.retry(obj, chat, attempt, e)
+            finally:
+                close_old_connections()
+
+    def throttle(self):
+        """所有工作线程共享的限速"""
+        with self._rate_lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def fetch(self, obj, chat):
+        content = chat.get_avatar()
+        if not content:
+            raise ValueError(f'{obj.puid}的头像为空')
+        obj.avatar.save(name=f'{obj.puid}.jpg', content=BytesIO(content), save=False)
+        obj.avatar_status = AVATAR_READY
+        # 只更新头像相关的字段,不覆盖其他线程的修改
+        updated = obj.__class__.objects.filter(pk=obj.pk).update(avatar=obj.avatar.name, avatar_status=AVATAR_READY)
+        if not updated:
+            # 创建联系人的事务还没有提交,稍后重试
+            raise LookupError(f'{obj.puid}还没有保存')
+        self.fetched += 1
+
+    def retry(self, obj, chat, attempt, error):
+        attempt += 1
+        if attempt < self.retries:
+            delay = self.backoff ** attempt
+            timer = threading.Timer(delay, self.queue.put, args=((obj, chat, attempt),))
+            timer.daemon = True
+            timer.start()
+            return
+        print(f'{obj.puid}头像获取失败: {error.args}')
+        self.failed += 1
+        obj.avatar_status = AVATAR_FAILED
+        obj.__class__.objects.filter(pk=obj.pk).update(avatar_status=AVATAR_FAILED)
+
+    def sweep(self, bot):
+        """重新提交`bot`的联系人里还在获取中的头像,队列满了或者进程重启时丢掉的任务会在登录和更新列表时补上"""
+        if not self.workers:
+            return 0
+        chats = {chat.puid: chat for chat in bot.chats() if getattr(chat, 'puid', None)}
+        if not chats:
+            return 0
+        count = 0
+        for model_name in ('WxUserModel', 'WxGroupModel'):
+            model = apps.get_model('wechat', model_name)
+            for obj in model.objects.filter(puid__in=list(chats), avatar_status=AVATAR_PENDING):
+                self.submit(obj, chats[obj.puid])
+                count += 1
+        return count
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'fetched': self.fetched,
+            'failed': self.failed,
+            'skipped': self.skipped,
+        }
+
+
+avatar_fetcher = AvatarFetcher(**AVATAR_FETCHER)
+metrics.register('avatar', avatar_fetcher.stats)
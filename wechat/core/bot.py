@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.db import close_old_connections
 
 from rest_framework.request import Request
 
@@ -14,10 +15,17 @@ from .. import models
 from . import exception
 from .const import *
 from . import utils
+from .http import http_client
+from .registry import bot_registry
+from .ingest import IngestQueue, INGEST
+from .contacts import ContactCache
+from .avatar import avatar_fetcher
+from .dedup import SeenMessages
+from .routing import MessageRouter
+from .metrics import metrics
 
 import os
 import time
-import requests
 import re
 
 
@@ -42,8 +50,14 @@ class BaseMessageBot(Bot):
 
         self.flag = flag
 
+        # 当前登录二维码的uuid和状态,状态变化时通知`check-login`
+        self.login_uuid = None
+        self.login_status = None
+
         self.alive_key = utils.get_alive_key(self.request)
 
+        self.contacts = ContactCache()
+
         super().__init__(cache_path=cache_path, console_qr=console_qr, qr_path=qr_path, qr_callback=qr_callback,
                          login_callback=login_callback,
                          logout_callback=logout_callback)
@@ -62,6 +76,9 @@ class BaseMessageBot(Bot):
         coon = get_redis_connection('default')
 
         coon.set(self.alive_key, 1)
+        if self.login_uuid:
+            coon.publish(utils.get_login_channel(self.login_uuid), 'alive')
+        metrics.register('contacts', self.contacts.stats, app=self.request.auth.app_id)
 
     def loginout_callback(self):
         print(f'{self.request.user}已退出!')
@@ -69,6 +86,8 @@ class BaseMessageBot(Bot):
         coon = get_redis_connection('default')
 
         coon.set(self.alive_key, 0)
+        bot_registry.unregister(self.request.auth.app_id, self)
+        metrics.unregister('contacts', app=self.request.auth.app_id)
 
     def qr_callback(self, uuid, status, qrcode):
         """默认的二维码回调函数"""
@@ -88,7 +107,7 @@ class BaseMessageBot(Bot):
             }
 
             # 请求当前用户的头像
-            resp = requests.get(url, params=params, headers=Header).text
+            resp = http_client.get(url, params=params).text
             """window.code=201;window.userAvatar = 'data:img/jpg;base64,<base64字符串>';"""
 
             # 正则提取base64字符串
@@ -102,15 +121,24 @@ class BaseMessageBot(Bot):
 
     def login_init(self, uuid, status, name=None):
         # 连接redis
-        # 将登陆时传的标记获取
         # 存入三个属性存入redis
+        # 二维码生成后通知等待的视图
         coon = get_redis_connection('default')
-        name = name or self.flag
+        name = name or uuid
+
+        pipe = coon.pipeline()
+        pipe.hmset(name, {'uuid': uuid, 'status': status, 'qrcode': f'https://login.weixin.qq.com/qrcode/{uuid}'})
+        pipe.expire(name, 60 * 10)
+        if status == '0':
+            ready_key = utils.get_qrcode_ready_key(self.flag)
+            pipe.rpush(ready_key, uuid)
+            pipe.expire(ready_key, 60 * 10)
+        # 等待扫码时会一直收到408,只有状态变化时才通知
+        if (uuid, status) != (self.login_uuid, self.login_status):
+            pipe.publish(utils.get_login_channel(uuid), status)
+        pipe.execute()
 
-        coon.hset(name, 'uuid', uuid)
-        coon.hset(name, 'status', status)
-        coon.hset(name, 'qrcode', f'https://login.weixin.qq.com/qrcode/{uuid}')
-        coon.expire(name, 60 * 10)
+        self.login_uuid, self.login_status = uuid, status
 
     def _qr_callback(self, uuid, status, qrcode):
         """根据不同的状态码执行不同的操作"""
@@ -119,10 +147,11 @@ class BaseMessageBot(Bot):
         if status == '201' or status == '200':
             self.scan_callback(uuid, status)
         elif status == '400':
+            # 先记录二维码过期的状态,再抛出异常
+            self.login_init(uuid, status)
             raise exception.LoginTimeOutException()
 
-        # 将key换成uuid
-        self.login_init(uuid, status, uuid)
+        self.login_init(uuid, status)
 
     @property
     def default_cache_path(self):
@@ -140,6 +169,13 @@ class BaseMessageBot(Bot):
         result = super().enable_puid(path)
         # 绑定用户
         self.bind()
+        # 登录完成,之后发消息和更新列表都复用这个bot
+        bot_registry.register(self.request.auth.app_id, self)
+        # 补上之前没有获取到的头像
+        try:
+            avatar_fetcher.sweep(self)
+        except Exception as e:
+            print(f'头像补充获取失败: {e.args}')
         return result
 
     def bind(self):
@@ -162,24 +198,96 @@ class CacheBot(Bot):
 
 
 class DefaultBot(BaseMessageBot):
-    default_message_conf = {'chats': None, 'msg_types': None, 'except_self': False, 'run_async': True,
+    # `listen`只做过滤和入队,不需要wxpy为每条消息启动一个线程,消息在共享的线程池里处理
+    default_message_conf = {'chats': None, 'msg_types': None, 'except_self': False, 'run_async': False,
                             'enabled': True}
     handler_classes = list()
 
     def initial(self):
         super().initial()
+        self.ingest = self.get_ingest_queue()
+        # 消息类型 -> 会处理这种消息的handle类
+        self.active_handler_classes = {}
+        for handle_class in self.get_handler_classes():
+            handle_class.setup(self)
         self.add_register()
 
+    def loginout_callback(self):
+        super().loginout_callback()
+        ingest = getattr(self, 'ingest', None)
+        if ingest is not None:
+            ingest.stop()
+            metrics.unregister('ingest', app=self.request.auth.app_id)
+
     def add_register(self):
         message_conf = self.kwrags.get('message_conf', self.default_message_conf)
         self.registered.append(MessageConfig(bot=self, func=self.listen, **message_conf))
 
+    def get_ingest_queue(self):
+        """获取消息队列,`workers`为0时返回None"""
+        conf = dict(INGEST, **self.kwrags.get('ingest', {}))
+        if not conf['workers']:
+            return None
+        ingest = IngestQueue(self.handle_message, self.request.auth.app_id, bot=self, discard=self.discard_message,
+                             **conf)
+        ingest.start()
+        metrics.register('ingest', ingest.stats, app=self.request.auth.app_id)
+        return ingest
+
     def listen(self, msg):
-        context = self.get_context()
-        handler_classes = self.get_handler_classes()
-        for handle_class in handler_classes:
-            handle = handle_class(msg, context)
-            handle.dispatch()
+        """收到消息后放到队列里,由工作线程处理,不阻塞接收消息"""
+        try:
+            metrics.incr('received', msg.type)
+            # 路由规则丢弃的消息和没有handle处理的消息不再解析
+            if not self.accept_message(msg):
+                metrics.incr('dropped', msg.type)
+                return
+            # 重复推送的消息不再解析和保存
+            if not SeenMessages.check(self.request.auth.app_id, msg.id):
+                metrics.incr('duplicated', msg.type)
+                return
+            if self.ingest is None:
+                return self.handle_message(msg)
+            self.ingest.put(msg)
+        finally:
+            # 接收消息的线程一直存在,需要自己回收过期的数据库连接
+            close_old_connections()
+
+    def discard_message(self, msg):
+        """队列丢掉或者退出登录后没有处理的消息,从去重集合里删掉,重新推送时还可以处理"""
+        SeenMessages.forget(self.request.auth.app_id, msg.id)
+
+    def accept_message(self, msg):
+        if not self.get_active_handler_classes(msg.type):
+            return False
+        return MessageRouter.accept(self.request.auth.app_id, msg)
+
+    def get_active_handler_classes(self, msg_type):
+        """去掉处理这种消息类型时什么都不做的handle,结果按消息类型缓存"""
+        if msg_type not in self.active_handler_classes:
+            self.active_handler_classes[msg_type] = [handle_class for handle_class in self.get_handler_classes()
+                                                     if handle_class.handles(msg_type)]
+        return self.active_handler_classes[msg_type]
+
+    def handle_message(self, msg):
+        msg_id, msg_type = msg.id, msg.type
+        try:
+            # 解析失败也需要从去重集合里删掉
+            msg = self.process_msg(msg)
+            with metrics.timer('handle', msg_type):
+                for handle_class in self.get_active_handler_classes(msg_type):
+                    handle = handle_class(msg, self.get_context())
+                    handle.dispatch()
+        except Exception:
+            metrics.incr('failed', msg_type)
+            SeenMessages.forget(self.request.auth.app_id, msg_id)
+            raise
+        finally:
+            close_old_connections()
+
+    def process_msg(self, msg):
+        """把wxpy的原始消息转换成handle需要的消息对象"""
+        return msg
 
     def get_context(self):
         return {
@@ -194,14 +302,11 @@ class DefaultBot(BaseMessageBot):
 class ModelMessageBot(DefaultBot):
     parse_message_class = message.ModelParseMessage
 
-    def listen(self, msg):
-        msg = self.process_msg(msg)
-        return super(ModelMessageBot, self).listen(msg)
-
     def process_msg(self, msg):
         assert self.parse_message_class is not None, '类属性`parse_message_class`不可以为`None`,或者你可以重写这个方法'
         context = self.get_context()
-        return self.parse_message_class(msg, context=context)
+        with metrics.timer('parse', msg.type):
+            return self.parse_message_class(msg, context=context)
 
 
 class SaveModelMessageBot(ModelMessageBot):
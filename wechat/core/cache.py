@@ -0,0 +1,118 @@
+from django.conf import settings
+
+from django_redis import get_redis_connection
+
+from collections import OrderedDict
+
+import threading
+import time
+
+INVALIDATE_CHANNEL = getattr(settings, 'CACHE_INVALIDATE_CHANNEL', 'wechat_cache_invalidate')
+
+
+class LRUCache:
+    """带过期时间的进程内LRU缓存,线程安全"""
+
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expire_at = item
+            if expire_at < time.monotonic():
+                # 已过期,直接删掉
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            # 超出容量时淘汰最久未使用的
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def discard_if(self, predicate):
+        """删除所有满足`predicate(key, value)`的缓存"""
+        with self._lock:
+            keys = [key for key, (value, _) in self._data.items() if predicate(key, value)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Invalidator:
+    """通过redis的发布订阅通知其他进程删除本地缓存
+
+    消息格式为`<name>:<key>`,`name`对应`subscribe`时注册的回调
+    """
+
+    def __init__(self, channel=INVALIDATE_CHANNEL):
+        self.channel = channel
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, name, callback):
+        """注册回调,监听线程在第一次用到缓存时通过`start`启动"""
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def publish(self, name, key, coon=None):
+        """通知所有进程(包括当前进程)删除缓存"""
+        self.dispatch(name, key)
+        try:
+            coon = coon or get_redis_connection('default')
+            coon.publish(self.channel, f'{name}:{key}')
+        except Exception as e:
+            print(f'缓存失效通知发送失败: {e.args}')
+
+    def dispatch(self, name, key):
+        for callback in self._callbacks.get(name, ()):
+            callback(key)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.listen, name='wechat-cache-invalidator', daemon=True)
+            self._thread.start()
+
+    def listen(self):
+        while True:
+            try:
+                coon = get_redis_connection('default')
+                pubsub = coon.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    name, _, key = message['data'].decode().partition(':')
+                    self.dispatch(name, key)
+            except Exception as e:
+                # 连接断开后稍等再重连,期间只能依靠ttl过期
+                print(f'缓存失效通知监听异常: {e.args}')
+                time.sleep(1)
+
+
+invalidator = Invalidator()
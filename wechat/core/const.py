@@ -3,3 +3,8 @@ Header = {
 }
 
 ALIVE = 1
+
+# 头像的获取状态
+AVATAR_PENDING = 0
+AVATAR_READY = 1
+AVATAR_FAILED = 2
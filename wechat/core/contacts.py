@@ -0,0 +1,61 @@
+from django.conf import settings
+
+from wxpy import User, Group, MP
+
+from wechat import models
+
+from .cache import LRUCache
+
+
+class ContactCache:
+    """bot维度的puid到`WxUserModel`/`WxGroupModel`/`WxMpsModel`的缓存,同步联系人列表时清空"""
+
+    def __init__(self, maxsize=getattr(settings, 'CONTACT_CACHE_SIZE', 5000),
+                 ttl=getattr(settings, 'CONTACT_CACHE_TTL', 3600)):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get_user(self, user: User):
+        return self.get(models.WxUserModel, user.puid, user, models.WxUserModel.get_user)
+
+    def get_group(self, group: Group):
+        return self.get(models.WxGroupModel, group.puid, group, models.WxGroupModel.get_group)
+
+    def get_mp(self, mp: MP):
+        return self.get(models.WxMpsModel, mp.puid, mp, models.WxMpsModel.get_mp)
+
+    def get_relater(self, relater):
+        """根据不同的聊天对象获取不同的model对象"""
+        if isinstance(relater, MP):
+            return self.get_mp(relater)
+        elif isinstance(relater, Group):
+            return self.get_group(relater)
+        elif isinstance(relater, User):
+            return self.get_user(relater)
+        raise Exception(f'{type(relater)}-未知的relater')
+
+    def get(self, model, puid, chat, getter):
+        key = (model.__name__, puid)
+        obj = self.cache.get(key)
+        if obj is None:
+            self.misses += 1
+            obj = getter(chat)
+            self.cache.set(key, obj)
+        else:
+            self.hits += 1
+        return obj
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses}
+
+
+def get_contacts(bot):
+    """获取bot的联系人缓存,没有的时候创建一个"""
+    contacts = getattr(bot, 'contacts', None)
+    if contacts is None:
+        contacts = bot.contacts = ContactCache()
+    return contacts
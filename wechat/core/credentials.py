@@ -0,0 +1,55 @@
+from django.conf import settings
+
+from django_redis import get_redis_connection
+
+from wechat.models import AppModel
+
+from . import exception
+from .cache import LRUCache, invalidator
+
+import hmac
+
+
+class Credentials:
+    """以`app_id`为key的进程内app凭证缓存,app保存后由`signals`通知删除"""
+    model = AppModel
+    cache = LRUCache(maxsize=getattr(settings, 'CREDENTIAL_CACHE_SIZE', 1024),
+                     ttl=getattr(settings, 'CREDENTIAL_CACHE_TTL', 300))
+
+    @classmethod
+    def get_app(cls, app_id, app_secret):
+        """根据`app_id`获取app,并用常量时间比较`app_secret`"""
+        app = cls.cache.get(app_id)
+        if app is None:
+            invalidator.start()
+            try:
+                app = cls.model.objects.select_related('bind').get(app_id=app_id)
+            except cls.model.DoesNotExist:
+                raise exception.AppDoesNotExistException()
+            cls.cache.set(app_id, app)
+
+        if not hmac.compare_digest(app.app_secret.encode(), app_secret.encode()):
+            raise exception.AppDoesNotExistException()
+        return app
+
+    @classmethod
+    def invalidate_app(cls, app_id):
+        cls.cache.pop(app_id)
+
+
+class ReplayWindow:
+    """记录时间窗口内已经使用过的签名,重复的签名视为重放请求"""
+    window = getattr(settings, 'SIGNATURE_TIMESTAMP_WINDOW', 3)
+    enabled = getattr(settings, 'SIGNATURE_REPLAY_CHECK', True)
+
+    @classmethod
+    def check(cls, app_id, signature):
+        """第一次出现的签名返回True"""
+        if not cls.enabled:
+            return True
+        coon = get_redis_connection('default')
+        # 时间戳前后各`window`秒内都有效,过期时间要覆盖整个窗口
+        return bool(coon.set(f'{app_id}_signature_{signature}', 1, ex=cls.window * 2 + 1, nx=True))
+
+
+invalidator.subscribe('app', Credentials.invalidate_app)
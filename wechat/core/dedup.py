@@ -0,0 +1,77 @@
+from django.conf import settings
+
+from django_redis import get_redis_connection
+
+from .metrics import metrics
+
+import time
+
+
+class SeenMessages:
+    """每个app最近收到的消息id,断线重连时重复推送的消息在解析之前就丢掉
+
+    保存在redis的有序集合里,分数为收到的时间,只保留`window`秒内的id
+    """
+    enabled = getattr(settings, 'MESSAGE_DEDUP', True)
+    window = getattr(settings, 'MESSAGE_DEDUP_WINDOW', 24 * 3600)
+
+    # KEYS: 集合; ARGV: 当前时间, 过期的分数, 消息id, 集合的过期时间
+    seen_script = """
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+    local added = redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return added
+    """
+    _seen_script = None
+
+    checked = 0
+    duplicated = 0
+
+    @classmethod
+    def get_key(cls, app_id):
+        return f'{app_id}_seen_messages'
+
+    @classmethod
+    def check(cls, app_id, msg_id):
+        """第一次收到的消息返回True,redis不可用时不做过滤"""
+        if not cls.enabled or msg_id is None:
+            return True
+        cls.checked += 1
+        now = time.time()
+        try:
+            coon = get_redis_connection('default')
+            script = cls.get_seen_script(coon)
+            added = script(keys=[cls.get_key(app_id)], args=[now, now - cls.window, msg_id, cls.window])
+        except Exception as e:
+            print(f'{app_id}消息去重失败: {e.args}')
+            return True
+        if not added:
+            cls.duplicated += 1
+        return bool(added)
+
+    @classmethod
+    def get_seen_script(cls, coon):
+        """注册lua脚本,之后通过`EVALSHA`调用,`Script`对象只创建一次"""
+        if cls._seen_script is None:
+            cls._seen_script = coon.register_script(cls.seen_script)
+        return cls._seen_script
+
+    @classmethod
+    def forget(cls, app_id, msg_id):
+        """处理失败的消息从集合里删掉,重新推送时还可以处理"""
+        if not cls.enabled or msg_id is None:
+            return
+        try:
+            get_redis_connection('default').zrem(cls.get_key(app_id), msg_id)
+        except Exception as e:
+            print(f'{app_id}消息去重失败: {e.args}')
+
+    @classmethod
+    def stats(cls):
+        return {
+            'checked': cls.checked,
+            'duplicated': cls.duplicated,
+        }
+
+
+metrics.register('dedup', SeenMessages.stats)
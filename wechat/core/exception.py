@@ -28,3 +28,15 @@ class PUIDSearchError(WeChatException):
 
 class SendMessageNotAllowedException(WeChatException):
     pass
+
+
+class BotRuntimeException(WeChatException):
+    pass
+
+
+class MediaTooLargeException(WeChatException):
+    pass
+
+
+class DuplicateMessageException(WeChatException):
+    pass
@@ -0,0 +1,118 @@
+from django.conf import settings
+
+from collections import deque
+
+from .metrics import metrics
+
+import threading
+
+MESSAGE_EXECUTOR = {'workers': 32}
+MESSAGE_EXECUTOR.update(getattr(settings, 'MESSAGE_EXECUTOR', {}))
+
+
+class FairExecutor:
+    """进程内所有bot共享的有界线程池
+
+    每个bot(`key`)一个任务队列,工作线程轮流从每个有任务的队列里取一个任务,
+    `limit`限制同一个bot同时运行的任务数,消息很多的bot不会占满所有的工作线程
+    """
+
+    def __init__(self, workers=32):
+        self.workers = workers
+        # key -> 等待执行的任务
+        self._queues = {}
+        # key -> 正在执行的任务数
+        self._running = {}
+        # key -> 同时运行的任务数上限
+        self._limits = {}
+        # 轮到执行的key
+        self._ready = deque()
+        self._scheduled = set()
+        self._cond = threading.Condition()
+        self._threads = []
+
+        self.finished = 0
+        self.failed = 0
+
+    def submit(self, key, func, *args, limit=None):
+        with self._cond:
+            self._queues.setdefault(key, deque()).append((func, args))
+            if limit is not None:
+                self._limits[key] = limit
+            self._schedule(key)
+        self.start()
+
+    def _schedule(self, key):
+        """有任务并且没有达到上限的key排到轮询的最后,调用前需要持有锁"""
+        if key in self._scheduled or not self._queues.get(key):
+            return
+        if self._running.get(key, 0) >= self._limits.get(key, self.workers):
+            return
+        self._scheduled.add(key)
+        self._ready.append(key)
+        self._cond.notify()
+
+    def start(self):
+        if self._threads:
+            return
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.work, name=f'wechat-executor-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                key = self._ready.popleft()
+                self._scheduled.discard(key)
+                func, args = self._queues[key].popleft()
+                self._running[key] = self._running.get(key, 0) + 1
+                # 还有任务就排到最后,等其他key都轮过一次
+                self._schedule(key)
+
+            failed = False
+            try:
+                func(*args)
+            except Exception as e:
+                failed = True
+                print(f'{key}任务执行失败: {e.args}')
+            finally:
+                with self._cond:
+                    self.finished += 1
+                    self.failed += failed
+                    self._running[key] -= 1
+                    if not self._running[key] and not self._queues[key]:
+                        self._clear(key)
+                    else:
+                        self._schedule(key)
+
+    def _clear(self, key):
+        self._running.pop(key, None)
+        self._queues.pop(key, None)
+        self._limits.pop(key, None)
+
+    def stats(self, key=None):
+        """`key`为None时返回整个线程池的统计"""
+        with self._cond:
+            if key is not None:
+                return {
+                    'active': self._running.get(key, 0),
+                    'queued': len(self._queues.get(key, ())),
+                }
+            return {
+                'workers': self.workers,
+                'active': sum(self._running.values()),
+                'queued': sum(len(queue) for queue in self._queues.values()),
+                'keys': len(self._queues),
+                'finished': self.finished,
+                'failed': self.failed,
+            }
+
+
+message_executor = FairExecutor(**MESSAGE_EXECUTOR)
+metrics.register('executor', message_executor.stats)
@@ -0,0 +1,251 @@
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, models
+from django.utils import timezone
+
+from wechat.models import ForwardMessageLog, ForwardOutboxModel
+
+from . import exception
+from .executor import FairExecutor
+from .http import HttpClient
+from .metrics import metrics
+
+from datetime import timedelta
+
+import json
+import random
+import threading
+import time
+import zlib
+
+# workers为0时在处理消息的线程里直接转发
+FORWARD_DISPATCHER = {'workers': 16, 'concurrency': 4, 'timeout': (3.05, 10)}
+FORWARD_DISPATCHER.update(getattr(settings, 'FORWARD_DISPATCHER', {}))
+
+# enabled为False时不保存待转发的消息,失败后不会重试
+FORWARD_OUTBOX = {'enabled': True, 'max_attempts': 10, 'base_delay': 2, 'max_delay': 3600, 'lease': 300,
+                  'interval': 5, 'batch_size': 100}
+FORWARD_OUTBOX.update(getattr(settings, 'FORWARD_OUTBOX', {}))
+
+
+class ForwardDispatcher:
+    """异步转发消息,处理消息的线程放到队列里就返回,不会被很慢的转发地址阻塞
+
+    每个转发地址有自己的连接池,最多同时发送`concurrency`个请求。
+    同一个会话的消息总是放到同一条通道里按顺序发送,不同会话的消息可以并发发送
+    """
+
+    def __init__(self, workers=16, concurrency=4, timeout=(3.05, 10)):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.executor = FairExecutor(workers=workers) if workers else None
+        # url -> HttpClient
+        self._clients = {}
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.delivered = 0
+        self.failed = 0
+
+    def get_client(self, url):
+        client = self._clients.get(url)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(url)
+                if client is None:
+                    conf = dict(getattr(settings, 'HTTP_CLIENT', {}))
+                    # 转发是post请求,不会自动重试,连接数和并发数一致
+                    conf.update(timeout=self.timeout, pool_connections=1, pool_maxsize=self.concurrency)
+                    client = self._clients[url] = HttpClient(**conf)
+        return client
+
+    def get_lane(self, url, conversation):
+        """会话对应的通道,同一个会话总是同一条通道"""
+        lane = zlib.crc32(str(conversation).encode()) % self.concurrency if conversation is not None else 0
+        return url, lane
+
+    def submit(self, app_id, url, data, conversation=None, msg_type='', outbox_id=None):
+        self.submitted += 1
+        if self.executor is None:
+            return self.deliver(app_id, url, data, msg_type, outbox_id)
+        # 每条通道同时只发送一个请求,保证同一个会话的消息按顺序到达
+        self.executor.submit(self.get_lane(url, conversation), self.deliver, app_id, url, data, msg_type, outbox_id,
+                             limit=1)
+
+    def deliver(self, app_id, url, data, msg_type='', outbox_id=None):
+        """`outbox_id`不为None时把转发结果记录到转发队列"""
+        # 在通道里排队的时间可能超过租期,开始发送时重新计算租期,已经被其他任务转发过的消息不再发送
+        if outbox_id is not None and not forward_outbox.renew(outbox_id):
+            return
+        try:
+            with metrics.timer('forward', msg_type):
+                self.send(app_id, url, data)
+        except Exception as e:
+            self.failed += 1
+            if outbox_id is not None:
+                forward_outbox.failed(outbox_id, e)
+            raise
+        else:
+            self.delivered += 1
+            if outbox_id is not None:
+                forward_outbox.delivered(outbox_id)
+        finally:
+            # 线程池的线程一直存在,需要自己回收过期的数据库连接
+            if self.executor is not None:
+                close_old_connections()
+
+    def send(self, app_id, url, data):
+        try:
+            resp = self.get_client(url).post(url, json=data)
+        except Exception as e:
+            # 保存错误信息
+            ForwardMessageLog.objects.create(app_id=app_id, content=e.args)
+            # 继续向上抛出异常
+            raise
+
+        if resp.text != 'ok':
+            # 保存错误信息
+            content = '发送失败!'
+            ForwardMessageLog.objects.create(app_id=app_id, content=content)
+            raise exception.ForwardFailError(content)
+        print('forward success')
+
+    def stats(self):
+        ret = {
+            'workers': self.workers,
+            'destinations': len(self._clients),
+            'submitted': self.submitted,
+            'delivered': self.delivered,
+            'failed': self.failed,
+        }
+        if self.executor is not None:
+            executor_stats = self.executor.stats()
+            ret.update(active=executor_stats['active'], queued=executor_stats['queued'])
+        return ret
+
+
+class ForwardOutbox:
+    """保存在数据库里的转发队列,保证每条消息至少转发成功一次
+
+    转发前先保存一条`pending`的记录,成功后标记为`delivered`,失败后按带随机抖动的指数退避
+    设置下次转发的时间,失败`max_attempts`次后标记为`dead`。后台线程每`interval`秒取出到期的记录重新转发。
+    取出记录时会把下次转发时间推后`lease`秒,多个进程不会同时转发同一条记录,进程退出后没有结果的记录过期后会被重新转发。
+    重试的消息可能排在同一个会话后面的消息之后,发送中的请求超过租期时同一条消息可能会被转发多次,接收方需要按消息id去重
+    """
+    model = ForwardOutboxModel
+
+    def __init__(self, enabled=True, max_attempts=10, base_delay=2, max_delay=3600, lease=300, interval=5,
+                 batch_size=100):
+        self.enabled = enabled
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.retried = 0
+        self.dead = 0
+
+    def add(self, app_id, url, data, conversation='', msg_type=''):
+        """保存待转发的消息,返回记录的id"""
+        row = self.model.objects.create(
+            app_id=app_id, url=url, conversation=conversation or '', msg_type=msg_type,
+            payload=json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False),
+            # 马上就会转发,后台线程在租期内不会取出这条记录
+            next_attempt_at=timezone.now() + timedelta(seconds=self.lease),
+        )
+        self.start()
+        return row.pk
+
+    def renew(self, pk):
+        """开始发送前延长租期,记录已经不是待转发的状态时返回False"""
+        leased_until = timezone.now() + timedelta(seconds=self.lease)
+        return bool(self.model.objects.filter(pk=pk, status='pending').update(next_attempt_at=leased_until))
+
+    def get_delay(self, attempts):
+        """第`attempts`次失败后等待的秒数,在退避时间的一半到全部之间随机"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def delivered(self, pk):
+        self.model.objects.filter(pk=pk).update(status='delivered', attempts=models.F('attempts') + 1,
+                                                last_error='', update_time=timezone.now())
+
+    def failed(self, pk, error):
+        row = self.model.objects.filter(pk=pk).only('attempts').first()
+        if row is None:
+            return
+        attempts = row.attempts + 1
+        values = {'attempts': attempts, 'last_error': str(error)[:255], 'update_time': timezone.now()}
+        if attempts >= self.max_attempts:
+            self.dead += 1
+            values['status'] = 'dead'
+        else:
+            values['next_attempt_at'] = timezone.now() + timedelta(seconds=self.get_delay(attempts))
+        self.model.objects.filter(pk=pk).update(**values)
+
+    def claim(self, queryset=None, limit=None):
+        """取出到期的记录,取出的记录在租期内不会被其他进程取出"""
+        queryset = self.model.objects.all() if queryset is None else queryset
+        now = timezone.now()
+        due = queryset.filter(status='pending', next_attempt_at__lte=now).order_by('next_attempt_at', 'id')
+        leased_until = now + timedelta(seconds=self.lease)
+
+        rows = []
+        for row in due[:limit or self.batch_size]:
+            # 下次转发时间没有被其他进程修改过才算取出成功
+            claimed = self.model.objects.filter(pk=row.pk, status='pending', next_attempt_at=row.next_attempt_at) \
+                .update(next_attempt_at=leased_until)
+            if claimed:
+                rows.append(row)
+        return rows
+
+    def redeliver(self, queryset):
+        """把记录重新设置为待转发,返回记录数"""
+        return queryset.update(status='pending', attempts=0, last_error='', next_attempt_at=timezone.now(),
+                               update_time=timezone.now())
+
+    def poll(self):
+        rows = self.claim()
+        for row in rows:
+            self.retried += 1
+            forward_dispatcher.submit(row.app_id, row.url, json.loads(row.payload), conversation=row.conversation,
+                                      msg_type=row.msg_type, outbox_id=row.pk)
+        return len(rows)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='wechat-forward-outbox', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                # 一批取满时说明还有到期的记录,马上继续取
+                if self.poll() >= self.batch_size:
+                    continue
+            except Exception as e:
+                print(f'转发队列处理失败: {e.args}')
+            finally:
+                close_old_connections()
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {
+            'retried': self.retried,
+            'dead': self.dead,
+        }
+
+
+forward_dispatcher = ForwardDispatcher(**FORWARD_DISPATCHER)
+forward_outbox = ForwardOutbox(**FORWARD_OUTBOX)
+metrics.register('forward', forward_dispatcher.stats)
+metrics.register('outbox', forward_outbox.stats)
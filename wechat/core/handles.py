@@ -1,11 +1,14 @@
 from wechat.serializers import MessageReadModelSerializer
-from wechat.models import ForwardMessageConfModel, ForwardMessageLog
+from wechat.models import ForwardMessageConfModel
 
 from .message import ModelParseMessage
 
 from . import exception
+from .forward import forward_dispatcher, forward_outbox
+from .writer import message_writer
+from .metrics import metrics
 
-import requests
+from concurrent.futures import Future
 
 
 class BaseHandle:
@@ -24,6 +27,18 @@ class BaseHandle:
         """默认的消息执行方法"""
         return self.do_nothing(**kwargs)
 
+    @classmethod
+    def setup(cls, bot):
+        """bot启动时调用,用于启动handle需要的后台任务"""
+        pass
+
+    @classmethod
+    def handles(cls, message_type):
+        """这种类型的消息会不会被处理,没有对应的方法并且没有重写`default_handle`和`dispatch`时不会处理"""
+        if cls.dispatch is not BaseHandle.dispatch or cls.default_handle is not BaseHandle.default_handle:
+            return True
+        return hasattr(cls, message_type.lower())
+
     def do_nothing(self, **kwargs):
         pass
 
@@ -37,10 +52,22 @@ class SaveMessageHandle(BaseHandle):
                           ModelParseMessage), f'`{self.__class__.__name__}` `message` 必须是`ModelParseMessage`的实例对象'
 
     def default_handle(self, **kwargs):
+        msg_type = self.message.type
         serializer = self.message.get_serializer()
-        data = serializer.data
+        with metrics.timer('serialize', msg_type):
+            data = serializer.data
         # 默认是执行`message`对象的`serializer`对象的保存消息方法
-        return serializer.message_create(data)
+        with metrics.timer('write', msg_type):
+            if message_writer is None:
+                try:
+                    obj = serializer.message_create(data)
+                except exception.DuplicateMessageException:
+                    # 重复的消息返回None
+                    return None
+                serializer.message_saved(obj)
+                return obj
+            # 开启批量写入时返回`Future`
+            return message_writer.submit(serializer, data)
 
 
 class ForwardMessageHandle(SaveMessageHandle):
@@ -51,14 +78,29 @@ class ForwardMessageHandle(SaveMessageHandle):
 
         # 执行父类的`default_handle`保存信息
         obj = super(ForwardMessageHandle, self).default_handle(**kwargs)
+        # 转发需要等消息写入完成
+        if isinstance(obj, Future):
+            try:
+                obj = obj.result()
+            except exception.DuplicateMessageException:
+                obj = None
+        # 重复的消息已经转发过了
+        if obj is None:
+            return
 
         # 序列化保存后的模型对象
         serializer = MessageReadModelSerializer(instance=obj.message)
         data = serializer.data
 
-        # 开始转发
+        # 放到转发队列里就返回,同一个会话的消息按顺序转发
         forward = self.get_forward()
-        self.forward(forward, data)
+        self.forward(forward, data, conversation=self.get_conversation(obj.message), msg_type=self.message.type)
+
+    @classmethod
+    def setup(cls, bot):
+        # 进程重启前没有转发成功的消息不需要等到有新消息才重试
+        if forward_outbox.enabled:
+            forward_outbox.start()
 
     def get_forward(self) -> ForwardMessageConfModel:
         """根据app获取转发配置"""
@@ -69,21 +111,14 @@ class ForwardMessageHandle(SaveMessageHandle):
         return forward_conf
 
     @staticmethod
-    def forward(forward_conf, data):
-        """转发"""
-        app, url = forward_conf.app, forward_conf.url
+    def get_conversation(message):
+        """会话和消息的方向无关,发送者和接收者的puid排序后拼接"""
+        return '-'.join(sorted((message.sender_puid, message.receiver_puid)))
 
-        try:
-            resp = requests.post(url, json=data)
-        except Exception as e:
-            # 保存错误信息
-            ForwardMessageLog.objects.create(app=app, content=e.args)
-            # 继续向上抛出异常
-            raise
-
-        if resp.text != 'ok':
-            # 保存错误信息
-            content = '发送失败!'
-            ForwardMessageLog.objects.create(app=app, content=content)
-            raise exception.ForwardFailError(content)
-        print('forward success')
+    @staticmethod
+    def forward(forward_conf, data, conversation=None, msg_type=''):
+        """转发,失败时保存错误信息到`ForwardMessageLog`,开启转发队列时失败的消息会重试"""
+        app_id, url = forward_conf.app_id, forward_conf.url
+        outbox_id = forward_outbox.add(app_id, url, data, conversation, msg_type) if forward_outbox.enabled else None
+        forward_dispatcher.submit(app_id, url, data, conversation=conversation, msg_type=msg_type,
+                                  outbox_id=outbox_id)
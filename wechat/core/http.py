@@ -0,0 +1,39 @@
+from django.conf import settings
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .const import Header
+
+import requests
+
+
+class HttpClient:
+    """所有对外的http请求都通过这个类发出,按host复用连接池,统一超时,重试和`User-Agent`"""
+
+    def __init__(self, timeout=(3.05, 10), retries=2, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                 pool_connections=10, pool_maxsize=20, headers=None):
+        self.timeout = timeout
+
+        # 默认只会重试幂等的请求,post失败不会重复发送
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or Header)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+# 可以在settings里面通过`HTTP_CLIENT`修改上面的默认参数
+http_client = HttpClient(**getattr(settings, 'HTTP_CLIENT', {}))
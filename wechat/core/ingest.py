@@ -0,0 +1,202 @@
+from django.conf import settings
+from django.db import close_old_connections
+
+from django_redis import get_redis_connection
+
+from wxpy.api.messages import Message
+
+from .executor import message_executor
+from .metrics import metrics
+
+import json
+import queue
+import threading
+import time
+
+# workers为同一个bot同时处理消息的线程数,为0时不使用队列,直接在`listen`里处理
+INGEST = {'workers': 4, 'maxsize': 1000, 'policy': 'block'}
+INGEST.update(getattr(settings, 'MESSAGE_INGEST', {}))
+
+
+class IngestQueue:
+    """`listen`和消息处理之间的有界队列,由所有bot共享的`message_executor`取出消息处理
+
+    队列满了之后的策略:
+        block: 阻塞`listen`直到队列有空位
+        drop_oldest: 丢掉最早的消息
+        spill: 把消息的原始数据放到redis里,内存队列空闲时再处理
+    """
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    SPILL = 'spill'
+
+    def __init__(self, handler, name, bot=None, maxsize=1000, workers=4, policy=BLOCK, executor=None, discard=None):
+        assert policy in (self.BLOCK, self.DROP_OLDEST, self.SPILL), f'未知的策略`{policy}`'
+        assert policy != self.SPILL or bot is not None, '`spill`策略需要传入`bot`来恢复消息'
+
+        self.handler = handler
+        # 没有处理就丢掉的消息会传给`discard`,例如从去重集合里删掉
+        self.discard = discard
+        self.name = name
+        self.bot = bot
+        self.workers = workers
+        self.policy = policy
+        self.spill_key = f'{name}_ingest_spill'
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.executor = executor or message_executor
+
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+
+        self._stopped = False
+        # 线程池里还没结束的`drain`任务数,不超过`workers`
+        self._tasks = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._stopped = False
+        # 进程重启前溢出到redis的消息
+        if self.policy == self.SPILL:
+            try:
+                depth = self.spill_depth()
+            except Exception as e:
+                print(f'{self.name}读取溢出的消息失败: {e.args}')
+                depth = 0
+            for _ in range(min(depth, self.workers)):
+                self.schedule()
+
+    def stop(self):
+        """不再接收新的消息,已经在队列里的消息会处理完"""
+        self._stopped = True
+
+    def put(self, msg):
+        if self._stopped:
+            return self.on_discard(msg)
+        self._put((time.time(), msg))
+        self.schedule()
+
+    def schedule(self):
+        """最多`workers`个`drain`任务,线程池里等待的任务数不会随着消息数增长"""
+        with self._lock:
+            if self._tasks >= self.workers:
+                return
+            self._tasks += 1
+        self.executor.submit(self.name, self.drain, limit=self.workers)
+
+    def _put(self, item):
+        if self.policy == self.BLOCK:
+            return self.queue.put(item)
+
+        while True:
+            try:
+                return self.queue.put_nowait(item)
+            except queue.Full:
+                if self.policy == self.SPILL:
+                    return self.spill(item)
+            # drop_oldest: 腾出一个位置后重试
+            try:
+                _, dropped = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+            self.on_discard(dropped)
+
+    def on_discard(self, msg):
+        if self.discard is None:
+            return
+        try:
+            self.discard(msg)
+        except Exception as e:
+            print(f'{self.name}丢弃消息失败: {e.args}')
+
+    def spill(self, item):
+        enqueued, msg = item
+        # 下载文件的函数等无法序列化的值会被丢掉
+        data = json.dumps({'enqueued': enqueued, 'raw': msg.raw}, default=lambda value: None)
+        coon = get_redis_connection('default')
+        coon.rpush(self.spill_key, data)
+        self.spilled += 1
+
+    def unspill(self):
+        """取出一条溢出到redis的消息,没有时返回None"""
+        coon = get_redis_connection('default')
+        data = coon.lpop(self.spill_key)
+        if data is None:
+            return None
+        data = json.loads(data)
+        return data['enqueued'], Message(data['raw'], self.bot)
+
+    def spill_depth(self):
+        return get_redis_connection('default').llen(self.spill_key)
+
+    def drain(self):
+        """取出一条消息处理,内存队列为空时处理溢出到redis的消息
+
+        处理完后重新提交任务排到其他bot的任务后面,没有消息时任务结束
+        """
+        item = self.get()
+        if item is None:
+            return
+        self.process(*item)
+        self.executor.submit(self.name, self.drain, limit=self.workers)
+
+    def get(self):
+        """取出下一条消息,没有消息时结束当前任务并返回None"""
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        item = self.safe_unspill()
+        if item is not None:
+            return item
+        with self._lock:
+            # 和`schedule`使用同一把锁,检查之后放进来的消息一定会有新的任务处理
+            try:
+                return self.queue.get_nowait()
+            except queue.Empty:
+                item = self.safe_unspill()
+            if item is None:
+                self._tasks -= 1
+            return item
+
+    def safe_unspill(self):
+        if self.policy != self.SPILL:
+            return None
+        try:
+            return self.unspill()
+        except Exception as e:
+            print(f'{self.name}读取溢出的消息失败: {e.args}')
+            return None
+
+    def process(self, enqueued, msg):
+        self.lag_last = lag = time.time() - enqueued
+        self.lag_max = max(self.lag_max, lag)
+        metrics.observe('queue', msg.type, lag)
+        try:
+            self.handler(msg)
+        except Exception as e:
+            self.failed += 1
+            print(f'{self.name}消息处理失败: {e.args}')
+        finally:
+            self.processed += 1
+            # 线程池的线程一直存在,需要自己回收过期的数据库连接
+            close_old_connections()
+
+    def stats(self):
+        executor_stats = self.executor.stats(self.name)
+        return {
+            'depth': self.queue.qsize(),
+            'active': executor_stats['active'],
+            'queued': executor_stats['queued'],
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'spill_depth': self.spill_depth() if self.policy == self.SPILL else 0,
+            'lag_last': self.lag_last,
+            'lag_max': self.lag_max,
+        }
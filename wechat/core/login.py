@@ -0,0 +1,89 @@
+from django.conf import settings
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import metrics
+
+import threading
+import time
+
+
+class LoginManager:
+    """有界的登录线程池,同一个app同时只会有一个正在进行的登录"""
+
+    def __init__(self, max_workers=10):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='wechat-login')
+        # app_id -> 登录标记
+        self._pending = {}
+        # 还没开始执行就被放弃的登录标记
+        self._abandoned = set()
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.finished = 0
+        self.failed = 0
+        self.duration_total = 0.0
+        self.duration_max = 0.0
+
+    def submit(self, app_id, func, flag):
+        """提交登录任务,返回`(flag, created)`,已经有登录在进行时返回原来的标记"""
+        with self._lock:
+            if app_id in self._pending:
+                return self._pending[app_id], False
+            self._pending[app_id] = flag
+            self.queued += 1
+        self.executor.submit(self._run, app_id, func, flag)
+        return flag, True
+
+    def abandon(self, app_id, flag):
+        """等待二维码超时后放弃这次登录,之后的登录请求不会再复用这个标记
+
+        还在排队的登录不会再执行,已经开始的登录无法中断,会一直运行到二维码过期
+        """
+        with self._lock:
+            if self._pending.get(app_id) != flag:
+                return False
+            self._pending.pop(app_id)
+            self._abandoned.add(flag)
+            return True
+
+    def _run(self, app_id, func, flag):
+        with self._lock:
+            self.queued -= 1
+            if flag in self._abandoned:
+                self._abandoned.discard(flag)
+                return
+            self.running += 1
+        start, failed = time.monotonic(), False
+        try:
+            func(flag)
+        except Exception as e:
+            failed = True
+            print(f'{app_id}登录失败: {e.args}')
+        finally:
+            duration = time.monotonic() - start
+            with self._lock:
+                # 放弃之后同一个app可能已经有新的登录了
+                if self._pending.get(app_id) == flag:
+                    self._pending.pop(app_id)
+                self._abandoned.discard(flag)
+                self.running -= 1
+                self.finished += 1
+                self.failed += failed
+                self.duration_total += duration
+                self.duration_max = max(self.duration_max, duration)
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'running': self.running,
+            'finished': self.finished,
+            'failed': self.failed,
+            'duration_avg': self.duration_total / self.finished if self.finished else 0.0,
+            'duration_max': self.duration_max,
+        }
+
+
+login_manager = LoginManager(max_workers=getattr(settings, 'LOGIN_MAX_WORKERS', 10))
+metrics.register('login', login_manager.stats)
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.core.files import File
+
+from itchat import config
+
+from .exception import MediaTooLargeException
+
+import os
+import tempfile
+
+# max_size为0时不限制文件大小, 超过spool_size的文件会写到临时文件里
+MEDIA_DOWNLOAD = {'chunk_size': 64 * 1024, 'max_size': 100 * 1024 * 1024, 'spool_size': 1024 * 1024,
+                  'timeout': (3.05, 60)}
+MEDIA_DOWNLOAD.update(getattr(settings, 'MEDIA_DOWNLOAD', {}))
+
+
+class MediaDownloader:
+    """分块下载图片、语音、视频、附件消息中的文件
+
+    和itchat的下载函数请求同样的地址,但不会把整个文件读进内存,
+    下载的内容先写到`SpooledTemporaryFile`里,超过`spool_size`后自动转存到磁盘,
+    最后以`File`的形式交给`FieldFile.save`分块写入存储
+    """
+
+    def __init__(self, chunk_size=64 * 1024, max_size=100 * 1024 * 1024, spool_size=1024 * 1024, timeout=(3.05, 60)):
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.spool_size = spool_size
+        self.timeout = timeout
+
+    def download(self, message):
+        """返回下载好的`File`,调用者负责关闭,超过最大体积时抛出`MediaTooLargeException`"""
+        path = getattr(message, 'path', None)
+        if path:
+            # 主动发送的消息,文件就在本地
+            self.check_size(os.path.getsize(path))
+            return File(open(path, 'rb'), name=os.path.basename(path))
+
+        self.check_size(message.raw.get('FileSize'))
+        try:
+            request = self.get_request(message)
+        except (AttributeError, KeyError, TypeError):
+            # 拿不到登录信息时(比如没有登录的bot),退回到itchat的下载函数
+            return self.download_by_itchat(message)
+
+        url, params, headers = request
+        session = message.bot.core.s
+        temp = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            with session.get(url, params=params, headers=headers, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                self.check_size(response.headers.get('Content-Length'))
+                size = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    self.check_size(size)
+                    temp.write(chunk)
+        except Exception:
+            temp.close()
+            raise
+        temp.seek(0)
+        return File(temp, name=message.file_name)
+
+    def download_by_itchat(self, message):
+        """让itchat把文件写到临时文件里"""
+        temp = tempfile.NamedTemporaryFile()
+        try:
+            message.get_file(save_path=temp.name)
+            self.check_size(temp.seek(0, 2))
+        except Exception:
+            temp.close()
+            raise
+        temp.seek(0)
+        return File(temp, name=message.file_name)
+
+    def check_size(self, size):
+        if self.max_size and size and int(size) > self.max_size:
+            raise MediaTooLargeException(f'文件大小超过了{self.max_size}字节')
+
+    @staticmethod
+    def get_request(message):
+        """按照itchat的`produce_msg`拼出下载地址,返回`(url, params, headers)`"""
+        core = message.bot.core
+        raw = message.raw
+        login_info = core.loginInfo
+        headers = {'User-Agent': config.USER_AGENT}
+        msg_type = message.type.lower()
+
+        if msg_type == 'attachment':
+            params = {
+                'sender': raw['FromUserName'],
+                'mediaid': raw['MediaId'],
+                'filename': raw['FileName'],
+                'fromuser': login_info['wxuin'],
+                'pass_ticket': 'undefined',
+                'webwx_data_ticket': core.s.cookies['webwx_data_ticket'],
+            }
+            return f'{login_info["fileUrl"]}/webwxgetmedia', params, headers
+
+        params = {'skey': login_info['skey']}
+        if msg_type == 'video':
+            params['msgid'] = raw['MsgId']
+            headers['Range'] = 'bytes=0-'
+            return f'{login_info["url"]}/webwxgetvideo', params, headers
+
+        params['msgid'] = raw['NewMsgId']
+        if msg_type == 'recording':
+            return f'{login_info["url"]}/webwxgetvoice', params, headers
+        if msg_type == 'picture':
+            return f'{login_info["url"]}/webwxgetmsgimg', params, headers
+        raise TypeError(f'`{message.type}`类型的消息没有文件')
+
+
+media_downloader = MediaDownloader(**MEDIA_DOWNLOAD)
@@ -11,10 +11,8 @@ class BaseParseMessage:
         self.request = context.pop('request', None)
 
     def __getattr__(self, item):
-        try:
-            return self.__getattribute__(item)
-        except AttributeError:
-            return getattr(self.message, item)
+        # 只有在自身找不到属性时才会调用,直接交给原始的message对象
+        return getattr(self.message, item)
 
 
 class ModelParseMessage(BaseParseMessage):
@@ -0,0 +1,156 @@
+from django.conf import settings
+
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import threading
+import time
+
+# enabled为False时计时和计数都是空操作; `/metrics`只允许`allowed_ips`访问或者带上`token`
+METRICS = {'enabled': False, 'buckets': (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10),
+           'token': None, 'allowed_ips': ('127.0.0.1', '::1')}
+METRICS.update(getattr(settings, 'METRICS', {}))
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 最后一个是超过所有上限的
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        cumulative, buckets = 0, OrderedDict()
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': buckets}
+
+
+class Metrics:
+    """消息处理各个阶段的耗时和计数,按阶段和消息类型分开统计
+
+    其他组件的`stats()`通过`register`注册,导出时一起输出
+    """
+
+    def __init__(self, enabled=False, buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)):
+        self.enabled = enabled
+        self.buckets = tuple(sorted(buckets))
+        # (阶段, 消息类型) -> Histogram
+        self.timers = {}
+        # (名称, 消息类型) -> 数量
+        self.counters = {}
+        # (名称, 标签) -> 返回dict的函数
+        self.collectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _timer(self, stage, msg_type):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, msg_type, time.perf_counter() - start)
+
+    def timer(self, stage, msg_type=''):
+        """`with metrics.timer('parse', 'Text'):`"""
+        if not self.enabled:
+            return _null_timer
+        return self._timer(stage, msg_type)
+
+    def observe(self, stage, msg_type, seconds):
+        if not self.enabled:
+            return
+        key = (stage, msg_type or '')
+        with self._lock:
+            histogram = self.timers.get(key)
+            if histogram is None:
+                histogram = self.timers[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def incr(self, name, msg_type='', value=1):
+        if not self.enabled:
+            return
+        key = (name, msg_type or '')
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register(self, name, collector, **labels):
+        """`collector`返回`{指标名: 数值}`"""
+        self.collectors[(name, tuple(sorted(labels.items())))] = collector
+
+    def unregister(self, name, **labels):
+        self.collectors.pop((name, tuple(sorted(labels.items()))), None)
+
+    def collect(self):
+        ret = []
+        for (name, labels), collector in list(self.collectors.items()):
+            try:
+                ret.append((name, dict(labels), collector()))
+            except Exception as e:
+                print(f'{name}指标获取失败: {e.args}')
+        return ret
+
+    def snapshot(self):
+        with self._lock:
+            timers = {f'{stage}:{msg_type}': histogram.snapshot() for (stage, msg_type), histogram in
+                      self.timers.items()}
+            counters = {f'{name}:{msg_type}': value for (name, msg_type), value in self.counters.items()}
+        components = [{'name': name, 'labels': labels, 'stats': stats} for name, labels, stats in self.collect()]
+        return {'enabled': self.enabled, 'timers': timers, 'counters': counters, 'components': components}
+
+    def export(self):
+        """Prometheus的文本格式"""
+        lines = []
+        with self._lock:
+            timers = [(key, histogram.snapshot()) for key, histogram in self.timers.items()]
+            counters = list(self.counters.items())
+
+        if timers:
+            lines.append('# TYPE wechat_stage_seconds histogram')
+        for (stage, msg_type), data in timers:
+            labels = f'stage="{stage}",type="{msg_type}"'
+            for bound, count in data['buckets'].items():
+                lines.append(f'wechat_stage_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'wechat_stage_seconds_sum{{{labels}}} {data["sum"]}')
+            lines.append(f'wechat_stage_seconds_count{{{labels}}} {data["count"]}')
+
+        if counters:
+            lines.append('# TYPE wechat_messages_total counter')
+        for (name, msg_type), value in counters:
+            lines.append(f'wechat_messages_total{{name="{name}",type="{msg_type}"}} {value}')
+
+        for name, labels, stats in self.collect():
+            label = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            label = f'{{{label}}}' if label else ''
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'wechat_{name}_{key}{label} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_timer = _NullTimer()
+
+metrics = Metrics(enabled=METRICS['enabled'], buckets=METRICS['buckets'])
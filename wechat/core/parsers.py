@@ -0,0 +1,80 @@
+from collections import namedtuple
+
+import html
+import re
+
+# 把名片,位置和分享消息的xml内容解析成结构化的记录
+# 正则只编译一次,每条消息只扫描一遍内容,缺少的属性使用默认值,不会抛出异常
+
+# 只匹配需要的属性,一次扫描取出所有的值
+CARD_PATTERN = re.compile(r'\s(username|nickname|alias|province|city|sign|sex|bigheadimgurl)="([^"]*)"')
+LOCATION_PATTERN = re.compile(r'\s(x|y|scale|label|maptype|poiname|poiid)="([^"]*)"')
+# 分享的`<appmsg>`里需要的元素,只取第一次出现的
+SHARING_PATTERN = re.compile(r'<(title|des|url|type)>(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?</\1>', re.S)
+
+CardRecord = namedtuple('CardRecord', ['username', 'nickname', 'alias', 'province', 'city', 'sign', 'sex', 'avatar'])
+MapRecord = namedtuple('MapRecord', ['x', 'y', 'scale', 'label', 'maptype', 'poiname', 'poiid'])
+SharingRecord = namedtuple('SharingRecord', ['title', 'description', 'url', 'app_type'])
+
+
+def unescape(content):
+    """网页版微信部分字段是转义过的xml"""
+    if not content:
+        return ''
+    if '&lt;' in content:
+        return html.unescape(content)
+    return content
+
+
+def to_number(value, number_type, default=None):
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def find_all(pattern, content):
+    """返回`{名称: 值}`,同名的只取第一个"""
+    ret = {}
+    for name, value in pattern.findall(unescape(content)):
+        if name not in ret:
+            ret[name] = html.unescape(value) if '&' in value else value
+    return ret
+
+
+def parse_card(content) -> CardRecord:
+    attrs = find_all(CARD_PATTERN, content)
+    return CardRecord(
+        username=attrs.get('username', ''),
+        nickname=attrs.get('nickname', ''),
+        alias=attrs.get('alias', ''),
+        province=attrs.get('province', ''),
+        city=attrs.get('city', ''),
+        sign=attrs.get('sign', ''),
+        sex=to_number(attrs.get('sex'), int),
+        avatar=attrs.get('bigheadimgurl', ''),
+    )
+
+
+def parse_map(content) -> MapRecord:
+    attrs = find_all(LOCATION_PATTERN, content)
+    # 位置消息表的数字字段不能为空,缺少时为0
+    return MapRecord(
+        x=to_number(attrs.get('x'), float, 0.0),
+        y=to_number(attrs.get('y'), float, 0.0),
+        scale=to_number(attrs.get('scale'), int, 0),
+        label=attrs.get('label', ''),
+        maptype=to_number(attrs.get('maptype'), int, 0),
+        poiname=attrs.get('poiname', ''),
+        poiid=attrs.get('poiid', ''),
+    )
+
+
+def parse_sharing(content) -> SharingRecord:
+    elements = find_all(SHARING_PATTERN, content)
+    return SharingRecord(
+        title=elements.get('title', '').strip(),
+        description=elements.get('des', '').strip(),
+        url=elements.get('url', '').strip(),
+        app_type=to_number(elements.get('type'), int),
+    )
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+
+import threading
+
+
+class BotRegistry:
+    """进程内以`app_id`为key的bot会话,登录后的bot会一直复用,不再每次都从pkl恢复"""
+
+    def __init__(self):
+        self._bots = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, app_id, bot):
+        with self._lock:
+            self._bots[app_id] = bot
+
+    def unregister(self, app_id, bot=None):
+        """删除bot,传入`bot`时只有是同一个对象才删除"""
+        with self._lock:
+            if bot is None or self._bots.get(app_id) is bot:
+                self._bots.pop(app_id, None)
+
+    def get(self, app_id):
+        """获取在线的bot,已经掉线的会被删掉"""
+        bot = self._bots.get(app_id)
+        if bot is not None and not self.is_healthy(bot):
+            self.unregister(app_id, bot)
+            return None
+        return bot
+
+    def get_or_load(self, app_id, loader):
+        """没有在线的bot时,调用`loader`创建并注册"""
+        bot = self.get(app_id)
+        if bot is not None:
+            return bot
+        # 同一个app同时只允许一个线程恢复会话
+        with self.lock(app_id):
+            bot = self.get(app_id)
+            if bot is None:
+                bot = loader()
+                self.register(app_id, bot)
+        return bot
+
+    @contextmanager
+    def lock(self, app_id):
+        """同一个app的操作串行执行"""
+        with self._lock:
+            lock = self._locks.setdefault(app_id, threading.RLock())
+        with lock:
+            yield
+
+    def health_check(self):
+        """清理所有已经掉线的bot,返回在线的app_id"""
+        for app_id in list(self._bots):
+            self.get(app_id)
+        return list(self._bots)
+
+    @staticmethod
+    def is_healthy(bot):
+        try:
+            return bool(bot.alive)
+        except Exception:
+            return False
+
+    def __len__(self):
+        return len(self._bots)
+
+
+bot_registry = BotRegistry()
@@ -0,0 +1,83 @@
+from django.conf import settings
+
+from wxpy import Group, MP
+
+from wechat.models import MessageRouteModel
+
+from .cache import LRUCache, invalidator
+from .metrics import metrics
+
+from collections import namedtuple
+
+Route = namedtuple('Route', ['msg_type', 'chat_kind', 'puid', 'accept'])
+
+
+def get_chat_kind(chat):
+    # `MP`是`User`的子类,要先判断
+    if isinstance(chat, MP):
+        return 'mp'
+    if isinstance(chat, Group):
+        return 'group'
+    return 'friend'
+
+
+class MessageRouter:
+    """按app缓存的路由表,在解析消息之前决定是否处理这条消息
+
+    规则按优先级匹配,第一条匹配的规则决定是否处理,都不匹配时处理
+    """
+    model = MessageRouteModel
+    cache = LRUCache(maxsize=getattr(settings, 'MESSAGE_ROUTE_CACHE_SIZE', 1024),
+                     ttl=getattr(settings, 'MESSAGE_ROUTE_CACHE_TTL', 300))
+
+    dropped = 0
+
+    @classmethod
+    def get_routes(cls, app_id):
+        routes = cls.cache.get(app_id)
+        if routes is None:
+            invalidator.start()
+            queryset = cls.model.objects.filter(app__app_id=app_id).order_by('priority', 'id')
+            routes = tuple(Route(msg_type=row.msg_type, chat_kind=row.chat_kind, puid=row.puid,
+                                 accept=row.action == 'accept') for row in queryset)
+            cls.cache.set(app_id, routes)
+        return routes
+
+    @classmethod
+    def accept(cls, app_id, msg):
+        """`msg`为wxpy的原始消息对象"""
+        routes = cls.get_routes(app_id)
+        if not routes:
+            return True
+        chat = msg.chat
+        chat_kind = None
+        for route in routes:
+            if route.msg_type and route.msg_type != msg.type:
+                continue
+            if route.chat_kind:
+                if chat_kind is None:
+                    chat_kind = get_chat_kind(chat)
+                if route.chat_kind != chat_kind:
+                    continue
+            # puid需要查询映射表,只在规则需要时获取
+            if route.puid and route.puid != getattr(chat, 'puid', None):
+                continue
+            if not route.accept:
+                cls.dropped += 1
+            return route.accept
+        return True
+
+    @classmethod
+    def invalidate_app(cls, app_id):
+        cls.cache.pop(app_id)
+
+    @classmethod
+    def stats(cls):
+        return {
+            'dropped': cls.dropped,
+        }
+
+
+invalidator.subscribe('app', MessageRouter.invalidate_app)
+invalidator.subscribe('route', MessageRouter.invalidate_app)
+metrics.register('routing', MessageRouter.stats)
@@ -0,0 +1,155 @@
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from django_redis import get_redis_connection
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from wechat import models
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import exception
+from . import utils
+from . import pkl_path
+from .login import login_manager
+from .registry import bot_registry
+
+import json
+import os
+import uuid
+import zlib
+
+# 开启后web进程不再运行bot,登录,发消息和更新列表都通过redis转发给`runbots`启动的bot进程
+ENABLED = getattr(settings, 'BOT_RUNTIME', False)
+WORKERS = getattr(settings, 'BOT_RUNTIME_WORKERS', 4)
+TIMEOUT = getattr(settings, 'BOT_RUNTIME_TIMEOUT', 30)
+THREADS = getattr(settings, 'BOT_RUNTIME_THREADS', 10)
+
+
+def get_shard(app_id):
+    """根据app_id分配bot进程"""
+    return zlib.crc32(app_id.encode()) % WORKERS
+
+
+def get_command_key(shard):
+    return f'wechat_bot_runtime_{shard}'
+
+
+def get_reply_key(command_id):
+    return f'wechat_bot_runtime_reply_{command_id}'
+
+
+class AppRequest:
+    """bot进程里代替`request`,bot和handle只用到了`auth`和`user`"""
+
+    def __init__(self, app):
+        self.auth = app
+
+    @property
+    def user(self):
+        return self.auth.bind
+
+
+class RuntimeClient:
+    """web进程向bot进程发送命令"""
+
+    def call(self, app_id, action, timeout=TIMEOUT, **kwargs):
+        """发送命令并等待结果,bot进程抛出的异常会在这里重新抛出"""
+        coon = get_redis_connection('default')
+        command_id = uuid.uuid4().hex
+        command = {'id': command_id, 'app_id': app_id, 'action': action, 'kwargs': kwargs}
+        coon.lpush(get_command_key(get_shard(app_id)), json.dumps(command, cls=JSONEncoder))
+
+        reply = coon.brpop(get_reply_key(command_id), timeout=max(int(timeout), 1))
+        if reply is None:
+            raise exception.BotRuntimeException('bot进程没有响应!')
+        reply = json.loads(reply[1])
+        if 'error' in reply:
+            exception_class = getattr(exception, reply['error'], exception.BotRuntimeException)
+            raise exception_class(reply['message'])
+        return reply['data']
+
+
+class BotRuntime:
+    """运行在独立进程里的bot容器,只处理分配给自己的app"""
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.command_key = get_command_key(shard)
+        self.executor = ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix=f'wechat-runtime-{shard}')
+
+    def run(self):
+        print(f'bot进程{self.shard}已启动, pid: {os.getpid()}')
+        from .forward import forward_outbox
+        # bot进程重启后不需要等到有新消息才重试转发
+        if forward_outbox.enabled:
+            forward_outbox.start()
+        coon = get_redis_connection('default')
+        while True:
+            item = coon.brpop(self.command_key, timeout=5)
+            if item is None:
+                bot_registry.health_check()
+                continue
+            command = json.loads(item[1])
+            # 登录会一直阻塞到扫码完成,其他命令也可能很慢,都放到线程池里执行
+            self.executor.submit(self.execute, command)
+
+    def execute(self, command):
+        close_old_connections()
+        try:
+            app = models.AppModel.objects.select_related('bind').get(app_id=command['app_id'])
+            handle = getattr(self, f'do_{command["action"]}')
+            reply = {'data': handle(app, **command['kwargs'])}
+        except Exception as e:
+            reply = {'error': e.__class__.__name__, 'message': str(e)}
+        finally:
+            close_old_connections()
+
+        try:
+            data = json.dumps(reply, cls=JSONEncoder)
+        except Exception as e:
+            # 结果无法序列化时也要回复,否则web进程只能等到超时
+            data = json.dumps({'error': 'BotRuntimeException', 'message': f'结果序列化失败: {e}'})
+
+        coon = get_redis_connection('default')
+        reply_key = get_reply_key(command['id'])
+        pipe = coon.pipeline()
+        pipe.lpush(reply_key, data)
+        pipe.expire(reply_key, TIMEOUT * 2)
+        pipe.execute()
+
+    def do_login(self, app, flag, bot_class):
+        """返回实际使用的登录标记,已经在登录的app返回原来的标记"""
+        bot_class = import_string(bot_class)
+
+        def bot_login(flag):
+            obj = bot_class(request=AppRequest(app), flag=flag)
+            obj.enable_puid(os.path.join(pkl_path, f'{app.app_id}.pkl'))
+
+        flag, _ = login_manager.submit(app.app_id, bot_login, flag)
+        return {'flag': flag}
+
+    def do_abandon_login(self, app, flag):
+        return login_manager.abandon(app.app_id, flag)
+
+    def do_send(self, app, puid, msg_type, text=None, file_path=None):
+        """上传的文件由bot进程发送完后删除,web进程等待超时的时候文件可能还在发送"""
+        from wechat.serializers import SendMessageSerializer
+
+        request = AppRequest(app)
+        try:
+            bot = utils.get_cache_bot(request)
+            with bot_registry.lock(app.app_id):
+                msg = utils.send_message(bot, puid, msg_type, text, file_path)
+        finally:
+            if file_path and os.path.exists(file_path):
+                os.remove(file_path)
+        return SendMessageSerializer(context={'request': request}).save_message(msg)
+
+    def do_update(self, app):
+        utils.update_app(utils.get_cache_bot(AppRequest(app)), app)
+
+
+runtime_client = RuntimeClient()
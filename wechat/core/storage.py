@@ -0,0 +1,157 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage, default_storage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+import hashlib
+import os
+import uuid
+
+# content_addressed为False时按`DEFAULT_FILE_STORAGE`原来的方式保存,不去重
+MEDIA_STORAGE = {'content_addressed': True}
+MEDIA_STORAGE.update(getattr(settings, 'MEDIA_STORAGE', {}))
+
+# 按内容存储的文件都放在这个目录下
+CAS_PREFIX = 'media/cas'
+
+
+@deconstructible
+class ContentAddressedStorage(Storage):
+    """按文件内容的sha256保存文件,内容相同的文件只保存一份
+
+    文件实际保存在`DEFAULT_FILE_STORAGE`里,`MediaBlob`记录每个文件被引用的次数,删除消息时减少引用,没有引用后删除文件
+    """
+
+    def __init__(self):
+        self.storage = default_storage
+        self.enabled = MEDIA_STORAGE['content_addressed']
+
+    def save(self, name, content, max_length=None):
+        if not self.enabled:
+            return self.storage.save(name, content, max_length=max_length)
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = self.get_hashed_name(content, name)
+        # 先增加引用再写文件,和`release`互斥,不会写入一个马上被删除的文件
+        self.acquire(name, content.size)
+        # 已经保存过的内容不再写一遍,多个线程同时保存相同的内容时都会写入,由`_save`保证不会冲突
+        if not self.exists(name):
+            try:
+                self._save(name, content)
+            except Exception:
+                self.release(name)
+                raise
+        return name
+
+    def _save(self, name, content):
+        if not self.is_local():
+            # 同名的文件内容一定相同,其他线程先保存了这个文件时存储可能会换一个名字保存,删掉多出来的一份
+            saved = self.storage.save(name, content)
+            if saved != name:
+                self.storage.delete(saved)
+            return name
+        # 先写到同一个目录下的临时文件再改名,同时写入相同内容的线程互不影响,后改名的直接覆盖
+        tmp_name = self.storage.save(f'{name}.{uuid.uuid4().hex}.tmp', content)
+        try:
+            os.replace(self.path(tmp_name), self.path(name))
+        except Exception:
+            self.storage.delete(tmp_name)
+            raise
+        return name
+
+    def is_local(self):
+        """文件是否保存在本地文件系统里,生成缩略图和迁移文件需要本地的路径"""
+        try:
+            self.storage.path('')
+        except NotImplementedError:
+            return False
+        return True
+
+    def _open(self, name, mode='rb'):
+        return self.storage.open(name, mode)
+
+    def delete(self, name):
+        return self.storage.delete(name)
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def listdir(self, path):
+        return self.storage.listdir(path)
+
+    def size(self, name):
+        return self.storage.size(name)
+
+    def url(self, name):
+        return self.storage.url(name)
+
+    def path(self, name):
+        return self.storage.path(name)
+
+    def get_valid_name(self, name):
+        return self.storage.get_valid_name(name)
+
+    def get_accessed_time(self, name):
+        return self.storage.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.storage.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.storage.get_modified_time(name)
+
+    @staticmethod
+    def get_hashed_name(content, name):
+        """根据内容计算保存的路径,保留原来的扩展名"""
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        # 其他存储保存时可能直接`read`,回到开头
+        try:
+            content.seek(0)
+        except (AttributeError, OSError):
+            pass
+        digest = sha256.hexdigest()
+        ext = os.path.splitext(name)[1].lower()
+        return f'{CAS_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{ext}'
+
+    @staticmethod
+    def is_hashed_name(name):
+        return bool(name) and name.startswith(f'{CAS_PREFIX}/')
+
+    @staticmethod
+    def acquire(name, size):
+        blob_model = apps.get_model('wechat', 'MediaBlob')
+        if blob_model.objects.filter(name=name).update(ref_count=F('ref_count') + 1):
+            return
+        try:
+            with transaction.atomic():
+                blob_model.objects.create(name=name, size=size, ref_count=1)
+        except IntegrityError:
+            # 其他线程刚刚创建了这个文件的记录
+            blob_model.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    def release(self, name):
+        """减少一次引用,没有引用时删除文件并返回True,不是按内容保存的文件不做处理"""
+        if not self.is_hashed_name(name):
+            return False
+        blob_model = apps.get_model('wechat', 'MediaBlob')
+        with transaction.atomic():
+            blob = blob_model.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                return False
+            if blob.ref_count > 1:
+                blob_model.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                return False
+            blob.delete()
+            self.delete(name)
+        return True
+
+
+cas_storage = ContentAddressedStorage()
@@ -0,0 +1,135 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .storage import cas_storage
+from .metrics import metrics
+
+import multiprocessing
+import os
+import threading
+
+# workers为0时在保存消息的线程里直接生成
+THUMBNAIL = {'workers': 2, 'sizes': [(120, 120), (480, 480)], 'quality': 85}
+THUMBNAIL.update(getattr(settings, 'THUMBNAIL', {}))
+
+THUMBNAIL_PREFIX = 'media/thumbs'
+
+
+def get_thumbnail_name(name, size):
+    """缩略图的路径由原图的路径决定,内容相同的图片共用缩略图"""
+    width, height = size
+    base = os.path.splitext(name)[0]
+    if base.startswith('media/'):
+        base = base[len('media/'):]
+    return f'{THUMBNAIL_PREFIX}/{width}x{height}/{base}.jpg'
+
+
+def render(path, thumbs, quality):
+    """在子进程里执行,返回原图的`(width, height)`"""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.load()
+        width, height = image.size
+        for size, thumb_path in thumbs:
+            if os.path.exists(thumb_path):
+                continue
+            thumb = image.copy()
+            thumb.thumbnail(size)
+            if thumb.mode not in ('RGB', 'L'):
+                thumb = thumb.convert('RGB')
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            thumb.save(thumb_path, 'JPEG', quality=quality)
+    return width, height
+
+
+class ThumbnailPipeline:
+    """在进程池里计算图片的尺寸和缩略图,不占用处理消息的线程
+
+    完成后把尺寸写回`PictureMessage`的`img_width`和`img_height`,有尺寸说明缩略图已经生成
+    """
+
+    def __init__(self, workers=2, sizes=((120, 120), (480, 480)), quality=85):
+        self.workers = workers
+        self.sizes = [tuple(size) for size in sizes]
+        self.quality = quality
+
+        self.submitted = 0
+        self.finished = 0
+        self.failed = 0
+
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # bot进程里有很多线程,用spawn启动子进程,避免fork时复制锁的状态
+                    context = multiprocessing.get_context('spawn')
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self._executor
+
+    def submit(self, obj):
+        """`obj`为已经保存的`PictureMessage`对象,文件不在本地文件系统里时不生成缩略图"""
+        if not obj.image or not cas_storage.is_local():
+            return
+        name = obj.image.name
+        thumbs = [(size, cas_storage.path(get_thumbnail_name(name, size))) for size in self.sizes]
+        args = (cas_storage.path(name), thumbs, self.quality)
+        self.submitted += 1
+
+        if not self.workers:
+            try:
+                result = render(*args)
+            except Exception as e:
+                return self.fail(obj.pk, e)
+            return self.save(obj.pk, result)
+
+        future = self.executor.submit(render, *args)
+        future.add_done_callback(partial(self.callback, obj.pk))
+
+    def callback(self, pk, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            return self.fail(pk, e)
+        try:
+            self.save(pk, result)
+        finally:
+            # 回调在进程池的管理线程里执行,需要自己回收数据库连接
+            close_old_connections()
+
+    def save(self, pk, result):
+        width, height = result
+        model = apps.get_model('wechat', 'PictureMessage')
+        model.objects.filter(pk=pk).update(img_width=width, img_height=height)
+        self.finished += 1
+
+    def fail(self, pk, error):
+        self.failed += 1
+        print(f'{pk}生成缩略图失败: {error.args}')
+
+    def get_thumbnails(self, name):
+        """返回`{'120x120': 缩略图路径}`"""
+        return {f'{width}x{height}': get_thumbnail_name(name, (width, height)) for width, height in self.sizes}
+
+    def delete(self, name):
+        for thumb_name in self.get_thumbnails(name).values():
+            cas_storage.delete(thumb_name)
+
+    def stats(self):
+        return {
+            'submitted': self.submitted,
+            'finished': self.finished,
+            'failed': self.failed,
+        }
+
+
+thumbnail_pipeline = ThumbnailPipeline(**THUMBNAIL)
+metrics.register('thumbnail', thumbnail_pipeline.stats)
@@ -6,8 +6,12 @@ from wechat.core import pkl_path
 from wxpy import Bot
 
 from .const import ALIVE
+from .registry import bot_registry
+from .contacts import get_contacts
 from . import exception
 
+from collections import OrderedDict
+
 import threading
 import os
 import time
@@ -33,9 +37,12 @@ def _update_single_app_info(app):
         print(f'{cache_path_name}不存在!')
         return
 
-    bot = Bot(cache_path=cache_path)
+    def load_bot():
+        bot = Bot(cache_path=cache_path)
+        bot.enable_puid(f'{app.app_id}.pkl')
+        return bot
 
-    bot.enable_puid(f'{app.app_id}.pkl')
+    bot = bot_registry.get_or_load(app.app_id, load_bot)
 
     update_app(bot, app)
 
@@ -49,6 +56,16 @@ def update_app(bot, app):
     groups_update.start()
     mps_update.start()
 
+    threading.Thread(target=clear_contacts, args=(bot, [friends_update, groups_update, mps_update]),
+                     daemon=True).start()
+
+
+def clear_contacts(bot, threads):
+    """等联系人都更新完后再清空缓存,更新过程中查询的联系人可能是旧的数据"""
+    for thread in threads:
+        thread.join()
+    get_contacts(bot).clear()
+
 
 def update_app_info_by_view(request):
     bot = get_cache_bot(request)
@@ -120,6 +137,78 @@ def get_alive_key(request):
     return f'{request.auth.app_id}_alive'
 
 
+def get_qrcode_ready_key(flag):
+    """二维码生成后会把uuid放到这个列表里"""
+    return f'{flag}_qrcode_ready'
+
+
+def get_login_channel(uuid):
+    """登录状态变化时的通知频道"""
+    return f'{uuid}_login_status'
+
+
+def get_login_state(coon, uuid, app_id):
+    """一次往返获取登录状态,头像和在线状态"""
+    pipe = coon.pipeline()
+    pipe.hmget(uuid, 'status', 'avatar')
+    pipe.get(f'{app_id}_alive')
+    (status, avatar), alive = pipe.execute()
+
+    state = OrderedDict()
+    state['status'] = status
+    state['avatar'] = avatar
+    state['alive'] = alive
+    return state
+
+
+def wait_login_state(coon, uuid, app_id, status, timeout):
+    """等待登录状态不再是`status`,超时返回当前状态"""
+    pubsub = coon.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(get_login_channel(uuid))
+    try:
+        deadline = time.monotonic() + timeout
+        # 订阅之后再读取状态,避免错过订阅之前的变化
+        state = get_login_state(coon, uuid, app_id)
+        while _decode(state['status']) == status:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            pubsub.get_message(timeout=remaining)
+            state = get_login_state(coon, uuid, app_id)
+        return state
+    finally:
+        pubsub.close()
+
+
+def iter_login_state(coon, uuid, app_id, timeout, heartbeat=15):
+    """登录状态每变化一次返回一次,直到登录完成,二维码过期或超时,等待期间返回None作为心跳"""
+    pubsub = coon.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(get_login_channel(uuid))
+    try:
+        deadline = time.monotonic() + timeout
+        last = None
+        while True:
+            state = get_login_state(coon, uuid, app_id)
+            if state != last:
+                last = state
+                yield state
+            status = _decode(state['status'])
+            if status == '400' or (status == '200' and _decode(state['alive']) == str(ALIVE)):
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if pubsub.get_message(timeout=min(remaining, heartbeat)) is None:
+                yield None
+    finally:
+        pubsub.close()
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
 def get_puid_path(request):
     return f'{request.auth.app_id}.pkl'
 
@@ -134,9 +223,19 @@ def get_bot_alive(request):
 
 
 def get_cache_bot(request):
+    """优先使用进程内在线的bot,没有的时候才从缓存恢复"""
+    app_id = request.auth.app_id
+    bot = bot_registry.get(app_id)
+    if bot is not None:
+        return bot
+
     alive = get_bot_alive(request)
     assert alive == ALIVE, '微信号不在线!无法使用缓存登陆'
 
+    return bot_registry.get_or_load(app_id, lambda: load_cache_bot(request))
+
+
+def load_cache_bot(request):
     cache_path = get_cache_path(request)
     bot = Bot(cache_path=cache_path)
     puid_path = get_puid_path(request)
@@ -0,0 +1,171 @@
+from django.conf import settings
+from django.db import transaction, close_old_connections, IntegrityError
+
+from wechat.models import MessageModel
+
+from .exception import DuplicateMessageException
+from .dedup import SeenMessages
+from .metrics import metrics
+
+from concurrent.futures import Future
+from collections import OrderedDict
+
+import queue
+import threading
+import time
+
+# batch_size为0时不使用批量写入,开启后`SaveMessageHandle.default_handle`返回`Future`
+MESSAGE_WRITER = {'batch_size': 0, 'delay': 0.05}
+MESSAGE_WRITER.update(getattr(settings, 'MESSAGE_WRITER', {}))
+
+
+class MessageWriter:
+    """把消息攒成一批,在一个事务里批量写入`MessageModel`和对应类型的消息表
+
+    最多等待`delay`秒或者攒够`batch_size`条就写入一次
+    """
+
+    def __init__(self, batch_size=100, delay=0.05):
+        self.batch_size = batch_size
+        self.delay = delay
+        self.queue = queue.Queue()
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.duplicated = 0
+
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, serializer, data):
+        """在调用者的线程里创建模型对象(包括保存文件),返回写入完成后的`Future`"""
+        obj = serializer.message_build(data)
+        future = Future()
+        self.queue.put((serializer, obj, future))
+        self.start()
+        return future
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name='wechat-message-writer', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.flush(batch)
+
+    def flush(self, batch):
+        try:
+            batch = self.discard_duplicates(batch)
+            with metrics.timer('bulk_write'):
+                self.bulk_create([obj for _, obj, _ in batch])
+        except Exception:
+            # 整批写入失败时逐条写入,只让出错的消息失败
+            for serializer, obj, future in batch:
+                try:
+                    self.create(obj)
+                except IntegrityError as e:
+                    if MessageModel.objects.filter(pk=obj.pk).exists():
+                        self.discard(serializer, obj, future)
+                        continue
+                    self.fail(serializer, obj, future, e)
+                except Exception as e:
+                    self.fail(serializer, obj, future, e)
+                else:
+                    self.saved(serializer, obj, future)
+                    self.written += 1
+        else:
+            for serializer, obj, future in batch:
+                self.saved(serializer, obj, future)
+            self.written += len(batch)
+        finally:
+            self.batches += 1
+            close_old_connections()
+
+    def discard_duplicates(self, batch):
+        """去掉数据库里已经存在的和同一批里重复的消息"""
+        ids = [obj.pk for _, obj, _ in batch]
+        existing = set(MessageModel.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        ret = []
+        for serializer, obj, future in batch:
+            if obj.pk in existing:
+                self.discard(serializer, obj, future)
+                continue
+            existing.add(obj.pk)
+            ret.append((serializer, obj, future))
+        return ret
+
+    def discard(self, serializer, obj, future):
+        try:
+            serializer.message_discarded(obj)
+        except Exception as e:
+            print(f'{obj.pk}丢弃失败: {e.args}')
+        future.set_exception(DuplicateMessageException(f'消息{obj.pk}已经保存过了'))
+        self.duplicated += 1
+
+    def fail(self, serializer, obj, future, error):
+        """写入失败的消息释放已经保存的文件,并且从去重集合里删掉,重新推送时还可以处理"""
+        try:
+            serializer.message_discarded(obj)
+        except Exception as e:
+            print(f'{obj.pk}丢弃失败: {e.args}')
+        request = serializer.context.get('request')
+        if request is not None and request.auth is not None:
+            SeenMessages.forget(request.auth.app_id, obj.pk)
+        future.set_exception(error)
+        self.failed += 1
+
+    @staticmethod
+    def saved(serializer, obj, future):
+        try:
+            serializer.message_saved(obj)
+        except Exception as e:
+            print(f'{obj.pk}写入后的处理失败: {e.args}')
+        future.set_result(obj)
+
+    @staticmethod
+    def bulk_create(objs):
+        # 按类型分组,每种消息表一条insert
+        groups = OrderedDict()
+        for obj in objs:
+            groups.setdefault(obj.__class__, []).append(obj)
+
+        with transaction.atomic():
+            MessageModel.objects.bulk_create([obj.message for obj in objs])
+            for model, items in groups.items():
+                model.objects.bulk_create(items)
+
+    @staticmethod
+    def create(obj):
+        with transaction.atomic():
+            obj.message.save(force_insert=True)
+            obj.save(force_insert=True)
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'batches': self.batches,
+            'written': self.written,
+            'failed': self.failed,
+            'duplicated': self.duplicated,
+        }
+
+
+message_writer = MessageWriter(**MESSAGE_WRITER) if MESSAGE_WRITER['batch_size'] else None
+
+if message_writer is not None:
+    metrics.register('writer', message_writer.stats)
@@ -0,0 +1,88 @@
+from django.core.management.base import BaseCommand
+
+from django_redis import get_redis_connection
+
+from wechat.core.access_token import AccessToken
+
+import time
+import uuid
+
+
+class Command(BaseCommand):
+    help = 'benchmark access token issuance, legacy multi-call path vs lua script'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=1000, help='tokens issued per path')
+        parser.add_argument('--apps', type=int, default=10, help='number of fake app ids to rotate through')
+
+    def handle(self, *args, **options):
+        number, apps = options['number'], options['apps']
+        coon = get_redis_connection('default')
+        app_ids = [f'bench-{uuid.uuid4().hex}' for _ in range(apps)]
+
+        for name, issue in (('legacy', self.issue_legacy), ('script', self.issue_script)):
+            ops = self.total_calls(coon)
+            round_trips = self.count_round_trips(coon)
+            start = time.perf_counter()
+            for i in range(number):
+                issue(coon, app_ids[i % apps])
+            cost = time.perf_counter() - start
+            round_trips = round_trips()
+            # 去掉`INFO`命令本身
+            ops = self.total_calls(coon) - ops - 1
+            self.stdout.write(f'{name:>6}: {cost / number * 1000:.3f} ms/token, '
+                              f'{round_trips / number:.2f} round trips/token, {ops / number:.2f} redis ops/token')
+
+        self.cleanup(coon, app_ids)
+
+    @staticmethod
+    def issue_legacy(coon, app_id):
+        """改造前`create_access_token`的redis调用顺序"""
+        token = uuid.uuid4().__str__()
+        coon.set(token, app_id)
+        coon.expire(token, AccessToken.expire_in)
+        key = f'{app_id}_access_token'
+        raw_token = coon.get(key)
+        if raw_token:
+            coon.delete(raw_token)
+        coon.set(key, token)
+        coon.expire(key, AccessToken.expire_in)
+
+    @staticmethod
+    def issue_script(coon, app_id):
+        token = uuid.uuid4().__str__()
+        key = f'{app_id}_access_token'
+        AccessToken.get_issue_script(coon)(keys=[key, token], args=[app_id, AccessToken.expire_in, ''])
+
+    @staticmethod
+    def count_round_trips(coon):
+        """统计客户端发出的命令数,返回的函数调用后停止统计"""
+        counter = [0]
+        execute_command = coon.execute_command
+
+        def wrapper(*args, **kwargs):
+            counter[0] += 1
+            return execute_command(*args, **kwargs)
+
+        coon.execute_command = wrapper
+
+        def stop():
+            del coon.execute_command
+            return counter[0]
+
+        return stop
+
+    @staticmethod
+    def total_calls(coon):
+        """服务端执行过的命令总数,包括lua脚本里调用的命令"""
+        stats = coon.info('commandstats')
+        return sum(item['calls'] for item in stats.values())
+
+    @staticmethod
+    def cleanup(coon, app_ids):
+        for app_id in app_ids:
+            key = f'{app_id}_access_token'
+            token = coon.get(key)
+            if token:
+                coon.delete(token)
+            coon.delete(key)
@@ -0,0 +1,104 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from wechat import serializers
+
+from collections import OrderedDict
+
+import time
+
+
+class BenchMessage:
+    """只有序列化需要的属性的消息对象"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+CARD_CONTENT = ('<msg username="wxid_bench" nickname="bench" alias="bench" province="广东" city="深圳" '
+                'sign="" sex="1" bigheadimgurl="http://example.com/avatar.jpg" />')
+MAP_CONTENT = ('<?xml version="1.0"?><msg><location x="22.5" y="113.9" scale="16" label="bench" maptype="0" '
+               'poiname="bench" poiid="" /></msg>')
+SHARING_CONTENT = ('<msg><appmsg><title>bench</title><des>bench</des><type>5</type>'
+                   '<url>http://example.com</url></appmsg></msg>')
+
+# 消息类型 -> (序列化类, 消息的属性)
+MESSAGES = OrderedDict([
+    ('text', (serializers.TextMessageModelSerializer, {'text': 'hello'})),
+    ('map', (serializers.MapMessageModelSerializer, {
+        'raw': {'OriContent': MAP_CONTENT, 'Text': 'bench'}, 'url': 'http://example.com', 'text': 'bench'})),
+    ('sharing', (serializers.SharingMessageModelSerializer, {
+        'raw': {'Content': SHARING_CONTENT}, 'url': 'http://example.com', 'text': 'bench'})),
+    ('picture', (serializers.PictureMessageModelSerializer, {'img_height': 600, 'img_width': 800})),
+    ('recording', (serializers.RecordingMessageModelSerializer, {'voice_length': 3000})),
+    ('video', (serializers.VideoMessageModelSerializer, {'play_length': 10})),
+    ('attachment', (serializers.AttachmentMessageModelSerializer, {'file_size': '1024'})),
+    ('card', (serializers.CardMessageModelSerializer, {'raw': {'Content': CARD_CONTENT}})),
+    ('note', (serializers.NoteMessageModelSerializer, {'text': 'bench'})),
+])
+
+
+def skip(field_name):
+    def handle(self, ret):
+        ret[field_name] = None
+        return ret
+
+    return handle
+
+
+class Command(BaseCommand):
+    help = 'benchmark message field extraction per message type, dynamic lookup vs compiled plan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=10000, help='messages serialized per path and type')
+        parser.add_argument('types', nargs='*', help='message types, all by default')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        for msg_type in options['types'] or MESSAGES:
+            serializer_class, attrs = MESSAGES[msg_type]
+            serializer_class = self.get_bench_class(serializer_class)
+            message = BenchMessage(**attrs)
+
+            costs = []
+            for extract in (self.extract_dynamic, self.extract_compiled):
+                start = time.perf_counter()
+                for _ in range(number):
+                    extract(serializer_class(instance=message), message)
+                costs.append(time.perf_counter() - start)
+
+            dynamic, compiled = costs
+            self.stdout.write(f'{msg_type:>10}: dynamic {dynamic / number * 1e6:8.2f} us/message, '
+                              f'compiled {compiled / number * 1e6:8.2f} us/message, {dynamic / compiled:.1f}x')
+
+    @staticmethod
+    def get_bench_class(serializer_class):
+        """`message`(联系人和数据库)和文件下载不在测试范围内,替换成空值"""
+        overrides = {'get_message_attr': skip('message')}
+        media_field = getattr(serializer_class, 'media_field', None)
+        if media_field:
+            overrides[f'get_{media_field}_attr'] = skip(media_field)
+        return type(f'Bench{serializer_class.__name__}', (serializer_class,), overrides)
+
+    @staticmethod
+    def extract_dynamic(serializer, instance):
+        """改造前`to_message_representation`的实现"""
+        with transaction.atomic():
+            ret = OrderedDict()
+            save_point = transaction.savepoint()
+            for field in serializer._readable_fields:
+                field_name = field.field_name
+                if hasattr(serializer, f'get_{field_name}_attr'):
+                    handle = getattr(serializer, f'get_{field_name}_attr')
+                    ret = handle(ret)
+                    continue
+                try:
+                    ret[field_name] = getattr(instance, field_name)
+                except AttributeError:
+                    transaction.savepoint_rollback(save_point)
+                    raise
+            return ret
+
+    @staticmethod
+    def extract_compiled(serializer, instance):
+        return serializer.to_message_representation(instance)
@@ -0,0 +1,62 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from wechat.models import MessageModel, TextMessage, WxUserModel
+from wechat.core.writer import MessageWriter, MESSAGE_WRITER
+
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'benchmark message persistence, per-message inserts vs batched bulk inserts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=2000, help='messages written per path')
+        parser.add_argument('--batch-size', type=int, default=MESSAGE_WRITER['batch_size'] or 100)
+
+    def handle(self, *args, **options):
+        number, batch_size = options['number'], options['batch_size']
+        content_type = ContentType.objects.get_for_model(WxUserModel)
+        # 使用随机的负数id,避免和真实的消息冲突
+        base = -random.randint(10 ** 12, 10 ** 15)
+
+        try:
+            objs = self.build(base, number, content_type)
+            start = time.perf_counter()
+            for obj in objs:
+                self.create_single(obj)
+            self.report('single', number, time.perf_counter() - start)
+
+            objs = self.build(base - number, number, content_type)
+            start = time.perf_counter()
+            for i in range(0, number, batch_size):
+                MessageWriter.bulk_create(objs[i:i + batch_size])
+            self.report(f'batch({batch_size})', number, time.perf_counter() - start)
+        finally:
+            MessageModel.objects.filter(id__gt=base - number * 2, id__lte=base).delete()
+
+    @staticmethod
+    def build(base, number, content_type):
+        now = timezone.now()
+        objs = []
+        for i in range(number):
+            message = MessageModel(id=base - i, type='Text', create_time=now, receive_time=now,
+                                   sender_content_type=content_type, sender_puid='bench',
+                                   receiver_content_type=content_type, receiver_puid='bench')
+            objs.append(TextMessage(message=message, text=f'bench {i}'))
+        return objs
+
+    @staticmethod
+    def create_single(obj):
+        """和逐条保存时一样: `to_message_representation`的事务和保存点,再加上`message_create`的事务"""
+        with transaction.atomic():
+            transaction.savepoint()
+            with transaction.atomic():
+                obj.message.save(force_insert=True)
+                obj.save(force_insert=True)
+
+    def report(self, name, number, cost):
+        self.stdout.write(f'{name:>12}: {number / cost:,.0f} messages/s, {cost / number * 1000:.3f} ms/message')
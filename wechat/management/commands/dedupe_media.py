@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from wechat.models import PictureMessage, RecordingMessage, AttachmentMessage, VideoMessage
+from wechat.core.storage import cas_storage, CAS_PREFIX
+
+
+class Command(BaseCommand):
+    help = 'move existing message media into the content addressed store and report the space reclaimed'
+
+    media_models = [PictureMessage, RecordingMessage, AttachmentMessage, VideoMessage]
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only report, do not move any file')
+
+    def handle(self, *args, **options):
+        if not cas_storage.enabled:
+            raise CommandError('content addressed storage is disabled, set MEDIA_STORAGE["content_addressed"] to True')
+        # 迁移时会把每个文件完整读一遍再删除,只支持本地文件系统
+        if not cas_storage.is_local():
+            raise CommandError('dedupe_media only supports a local file system storage')
+        dry_run = options['dry_run']
+        # 本次迁移中已经处理过的内容,用于试运行时统计重复
+        seen = set()
+        total = {'files': 0, 'missing': 0, 'before': 0, 'after': 0}
+
+        for model in self.media_models:
+            field = next(f for f in model._meta.get_fields() if isinstance(f, models.FileField))
+            queryset = model.objects.exclude(**{field.name: ''}) \
+                .exclude(**{f'{field.name}__startswith': f'{CAS_PREFIX}/'})
+            for obj in queryset.iterator():
+                self.migrate(obj, field, dry_run, seen, total)
+
+        reclaimed = total['before'] - total['after']
+        self.stdout.write(f'files: {total["files"]}, missing: {total["missing"]}')
+        self.stdout.write(f'before: {self.format_size(total["before"])}, after: {self.format_size(total["after"])}')
+        self.stdout.write(f'{"reclaimable" if dry_run else "reclaimed"}: {self.format_size(reclaimed)}')
+
+    @staticmethod
+    def migrate(obj, field, dry_run, seen, total):
+        file = getattr(obj, field.name)
+        # 原来的文件是用默认的存储保存的,路径相同
+        old_name = file.name
+        if not cas_storage.exists(old_name):
+            total['missing'] += 1
+            return
+
+        with cas_storage.open(old_name) as content:
+            size = content.size
+            new_name = cas_storage.get_hashed_name(content, old_name)
+            duplicated = new_name in seen or cas_storage.exists(new_name)
+            if not dry_run:
+                new_name = cas_storage.save(old_name, content)
+
+        seen.add(new_name)
+        total['files'] += 1
+        total['before'] += size
+        if not duplicated:
+            total['after'] += size
+        if dry_run:
+            return
+        obj.__class__.objects.filter(pk=obj.pk).update(**{field.name: new_name})
+        cas_storage.delete(old_name)
+
+    @staticmethod
+    def format_size(size):
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if size < 1024:
+                return f'{size:.1f}{unit}'
+            size /= 1024
+        return f'{size:.1f}TB'
@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime, parse_date
+
+from wechat.models import ForwardOutboxModel
+from wechat.core.forward import forward_outbox, forward_dispatcher
+
+from datetime import datetime, time
+
+import json
+
+
+class Command(BaseCommand):
+    help = 'redeliver forwarded messages created in a time range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('since', help='start of the range, e.g. 2020-02-12 or "2020-02-12 10:00"')
+        parser.add_argument('until', nargs='?', help='end of the range (exclusive), now by default')
+        parser.add_argument('--app', help='only messages of this app_id')
+        parser.add_argument('--status', nargs='+', choices=[status for status, _ in ForwardOutboxModel.STATUS_CHOICES],
+                            help='only messages in these states, all by default')
+        parser.add_argument('--dry-run', action='store_true', help='only count the messages')
+        parser.add_argument('--queue', action='store_true',
+                            help='mark the messages pending and leave them to the bot processes')
+
+    def handle(self, *args, **options):
+        since = self.parse_time(options['since'])
+        until = self.parse_time(options['until']) if options['until'] else timezone.now()
+
+        queryset = ForwardOutboxModel.objects.filter(create_time__gte=since, create_time__lt=until)
+        if options['app']:
+            queryset = queryset.filter(app__app_id=options['app'])
+        if options['status']:
+            queryset = queryset.filter(status__in=options['status'])
+
+        if options['dry_run']:
+            self.stdout.write(f'messages: {queryset.count()}')
+            return
+
+        ids = list(queryset.values_list('pk', flat=True))
+        count = forward_outbox.redeliver(ForwardOutboxModel.objects.filter(pk__in=ids))
+        self.stdout.write(f'messages: {count}')
+        if options['queue']:
+            return
+
+        # 在当前进程里按创建顺序转发,失败的消息按退避时间交给bot进程重试
+        delivered = failed = 0
+        queryset = ForwardOutboxModel.objects.filter(pk__in=ids).order_by('create_time', 'id')
+        while True:
+            rows = forward_outbox.claim(queryset)
+            if not rows:
+                break
+            for row in rows:
+                try:
+                    forward_dispatcher.deliver(row.app_id, row.url, json.loads(row.payload), row.msg_type, row.pk)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{row.pk}: {e.args}')
+                else:
+                    delivered += 1
+        self.stdout.write(f'delivered: {delivered}, failed: {failed}')
+
+    @staticmethod
+    def parse_time(value):
+        try:
+            parsed = parse_datetime(value)
+            if parsed is None:
+                date = parse_date(value)
+                parsed = datetime.combine(date, time.min) if date else None
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise CommandError(f'invalid time: {value}')
+        if settings.USE_TZ and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        return parsed
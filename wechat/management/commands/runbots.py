@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from wechat.core import runtime
+
+import multiprocessing
+
+
+class Command(BaseCommand):
+    help = 'run wechat bots in dedicated processes, sharded by app_id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shard', type=int, default=None,
+                            help='only run the given shard, for running each shard under a process supervisor')
+
+    def handle(self, *args, **options):
+        shard = options.get('shard')
+        if shard is not None:
+            return runtime.BotRuntime(shard).run()
+
+        # fork之前关掉数据库连接,避免子进程共用同一个连接
+        connections.close_all()
+        processes = [multiprocessing.Process(target=self.run_shard, args=(shard,), name=f'wechat-runtime-{shard}')
+                     for shard in range(runtime.WORKERS)]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'started {len(processes)} bot processes')
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+
+    @staticmethod
+    def run_shard(shard):
+        runtime.BotRuntime(shard).run()
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.5 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0004_forwardmessagelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wxgroupmodel',
+            name='avatar_status',
+            field=models.SmallIntegerField(choices=[(0, '获取中'), (1, '已获取'), (2, '获取失败')], default=1, verbose_name='头像状态'),
+        ),
+        migrations.AddField(
+            model_name='wxusermodel',
+            name='avatar_status',
+            field=models.SmallIntegerField(choices=[(0, '获取中'), (1, '已获取'), (2, '获取失败')], default=1, verbose_name='头像状态'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.1.5 on 2026-10-19 11:00
+
+from django.db import migrations, models
+import wechat.core.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0005_avatar_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='文件路径')),
+                ('size', models.BigIntegerField(verbose_name='文件大小')),
+                ('ref_count', models.IntegerField(default=0, verbose_name='引用次数')),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': '消息文件',
+                'verbose_name_plural': '消息文件',
+            },
+        ),
+        migrations.AlterField(
+            model_name='attachmentmessage',
+            name='file',
+            field=models.FileField(max_length=500, storage=wechat.core.storage.ContentAddressedStorage(), upload_to='media/file/%Y/%m/%d'),
+        ),
+        migrations.AlterField(
+            model_name='picturemessage',
+            name='image',
+            field=models.ImageField(storage=wechat.core.storage.ContentAddressedStorage(), upload_to='media/image/%Y/%m/%d', verbose_name='头像'),
+        ),
+        migrations.AlterField(
+            model_name='recordingmessage',
+            name='record',
+            field=models.FileField(storage=wechat.core.storage.ContentAddressedStorage(), upload_to='media/record/%Y/%m/%d'),
+        ),
+        migrations.AlterField(
+            model_name='videomessage',
+            name='video',
+            field=models.FileField(storage=wechat.core.storage.ContentAddressedStorage(), upload_to='media/video/%Y/%m/%d'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.1.5 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0006_mediablob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageRouteModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('priority', models.IntegerField(default=0, help_text='数字越小越先匹配', verbose_name='优先级')),
+                ('msg_type', models.CharField(blank=True, choices=[('Text', '文本'), ('Map', '位置'), ('Card', '名片'), ('Note', '提示'), ('Sharing', '分享'), ('Picture', '图片'), ('Recording', '语音'), ('Attachment', '文件'), ('Video', '视频'), ('Friends', '好友请求'), ('System', '系统')], help_text='为空时匹配所有类型', max_length=15, verbose_name='消息类型')),
+                ('chat_kind', models.CharField(blank=True, choices=[('friend', '好友'), ('group', '群'), ('mp', '公众号')], help_text='为空时匹配所有聊天对象', max_length=10, verbose_name='聊天对象类型')),
+                ('puid', models.CharField(blank=True, help_text='为空时匹配所有聊天对象', max_length=15, verbose_name='聊天对象puid')),
+                ('action', models.CharField(choices=[('accept', '处理'), ('drop', '丢弃')], default='drop', max_length=10, verbose_name='动作')),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routes', to='wechat.AppModel')),
+            ],
+            options={
+                'verbose_name': '消息路由',
+                'verbose_name_plural': '消息路由',
+                'ordering': ['priority', 'id'],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 2.1.5 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat', '0007_messageroutemodel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ForwardOutboxModel',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField(verbose_name='转发地址')),
+                ('conversation', models.CharField(blank=True, max_length=32, verbose_name='会话')),
+                ('msg_type', models.CharField(blank=True, max_length=15, verbose_name='消息类型')),
+                ('payload', models.TextField(verbose_name='消息内容')),
+                ('status', models.CharField(choices=[('pending', '待转发'), ('delivered', '已转发'), ('dead', '放弃')], default='pending', max_length=10, verbose_name='状态')),
+                ('attempts', models.IntegerField(default=0, verbose_name='转发次数')),
+                ('next_attempt_at', models.DateTimeField(db_index=True, verbose_name='下次转发时间')),
+                ('last_error', models.CharField(blank=True, max_length=255, verbose_name='最后一次错误')),
+                ('create_time', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wechat.AppModel')),
+            ],
+            options={
+                'verbose_name': '转发队列',
+                'verbose_name_plural': '转发队列',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='forwardoutboxmodel',
+            index_together={('status', 'next_attempt_at')},
+        ),
+    ]
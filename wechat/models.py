@@ -1,16 +1,24 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 
 from wxpy.api.bot import User, Group, MP
 
-from io import BytesIO
+from wechat.core.avatar import avatar_fetcher
+from wechat.core.storage import cas_storage
+from wechat.core.const import AVATAR_PENDING, AVATAR_READY, AVATAR_FAILED
 
 import uuid
 
 
 # Create your models here.
 
+AVATAR_STATUS_CHOICES = (
+    (AVATAR_PENDING, '获取中'),
+    (AVATAR_READY, '已获取'),
+    (AVATAR_FAILED, '获取失败'),
+)
+
 
 class AppModel(models.Model):
     create_time = models.DateTimeField(auto_now_add=True)
@@ -57,6 +65,34 @@ class ForwardMessageLog(models.Model):
         verbose_name = verbose_name_plural = '转发log表'
 
 
+class ForwardOutboxModel(models.Model):
+    """每条需要转发的消息,转发成功之前一直保留,失败后按指数退避重试"""
+    STATUS_CHOICES = (
+        ('pending', '待转发'),
+        ('delivered', '已转发'),
+        ('dead', '放弃'),
+    )
+
+    app = models.ForeignKey('AppModel', on_delete=models.CASCADE)
+    url = models.URLField(verbose_name='转发地址')
+    conversation = models.CharField(max_length=32, blank=True, verbose_name='会话')
+    msg_type = models.CharField(max_length=15, blank=True, verbose_name='消息类型')
+    payload = models.TextField(verbose_name='消息内容')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name='状态')
+    attempts = models.IntegerField(default=0, verbose_name='转发次数')
+    next_attempt_at = models.DateTimeField(db_index=True, verbose_name='下次转发时间')
+    last_error = models.CharField(max_length=255, blank=True, verbose_name='最后一次错误')
+    create_time = models.DateTimeField(auto_now_add=True, db_index=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = verbose_name_plural = '转发队列'
+        index_together = [('status', 'next_attempt_at')]
+
+    def __str__(self):
+        return f'{self.app_id}-{self.status}'
+
+
 class WxUserModel(models.Model):
     SEX_CHOICES = (
         (1, '男'),
@@ -68,6 +104,7 @@ class WxUserModel(models.Model):
     user_name = models.CharField(max_length=80, verbose_name='用户名', null=True)
     remark_name = models.CharField(max_length=32, verbose_name='备注名', null=True)
     avatar = models.ImageField(verbose_name="头像", upload_to="media/avatar/users/%Y/%m/%d")
+    avatar_status = models.SmallIntegerField(choices=AVATAR_STATUS_CHOICES, default=AVATAR_READY, verbose_name='头像状态')
     signature = models.CharField(max_length=255, verbose_name="签名", null=True)
     sex = models.IntegerField(choices=SEX_CHOICES, verbose_name="性别", null=True)
     province = models.CharField(max_length=15, verbose_name="省", null=True)
@@ -94,8 +131,10 @@ class WxUserModel(models.Model):
                 sex=bot.sex,
                 province=bot.province,
                 city=bot.city,
+                avatar_status=AVATAR_PENDING,
             )
-            obj.avatar.save(name=f'{bot.puid}.jpg', content=BytesIO(bot.get_avatar()))
+            # 头像在后台下载,等联系人提交之后再提交任务
+            transaction.on_commit(lambda: avatar_fetcher.submit(obj, bot))
         return obj
 
     class Meta:
@@ -108,6 +147,7 @@ class WxGroupModel(models.Model):
     nick_name = models.CharField(max_length=32, verbose_name='昵称')
     user_name = models.CharField(max_length=80)
     avatar = models.ImageField(verbose_name='头像', upload_to="media/avatar/groups/%Y/%m/%d")
+    avatar_status = models.SmallIntegerField(choices=AVATAR_STATUS_CHOICES, default=AVATAR_READY, verbose_name='头像状态')
     members = models.ManyToManyField(WxUserModel, related_name='members', verbose_name='群员')
     owner = models.ForeignKey(WxUserModel, on_delete=models.CASCADE, null=True, verbose_name='群归属')
 
@@ -126,9 +166,11 @@ class WxGroupModel(models.Model):
                 name=group.name,
                 nick_name=group.nick_name,
                 user_name=group.user_name,
-                owner=WxUserModel.get_user(group.bot.self)
+                owner=WxUserModel.get_user(group.bot.self),
+                avatar_status=AVATAR_PENDING,
             )
-            obj.avatar.save(name=f'{group.puid}.jpg', content=BytesIO(group.get_avatar()))
+            # 头像在后台下载,等联系人提交之后再提交任务
+            transaction.on_commit(lambda: avatar_fetcher.submit(obj, group))
         return obj
 
     class Meta:
@@ -207,6 +249,35 @@ class MessageModel(models.Model):
         return f'{self.type}-{self.owner.name}'
 
 
+class MessageRouteModel(models.Model):
+    """消息路由,在解析消息之前按顺序匹配,第一条匹配的规则决定是否处理这条消息"""
+    CHAT_KIND_CHOICES = (
+        ('friend', '好友'),
+        ('group', '群'),
+        ('mp', '公众号'),
+    )
+    ACTION_CHOICES = (
+        ('accept', '处理'),
+        ('drop', '丢弃'),
+    )
+
+    app = models.ForeignKey('AppModel', on_delete=models.CASCADE, related_name='routes')
+    priority = models.IntegerField(default=0, verbose_name='优先级', help_text='数字越小越先匹配')
+    msg_type = models.CharField(max_length=15, choices=MessageModel.TYPE_CHOICES, blank=True,
+                                verbose_name='消息类型', help_text='为空时匹配所有类型')
+    chat_kind = models.CharField(max_length=10, choices=CHAT_KIND_CHOICES, blank=True,
+                                 verbose_name='聊天对象类型', help_text='为空时匹配所有聊天对象')
+    puid = models.CharField(max_length=15, blank=True, verbose_name='聊天对象puid', help_text='为空时匹配所有聊天对象')
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, default='drop', verbose_name='动作')
+
+    class Meta:
+        verbose_name = verbose_name_plural = '消息路由'
+        ordering = ['priority', 'id']
+
+    def __str__(self):
+        return f'{self.app.app_name}-{self.get_action_display()}'
+
+
 class BaseMessage(models.Model):
     message = models.OneToOneField(MessageModel, on_delete=models.CASCADE, primary_key=True)
 
@@ -257,7 +328,7 @@ class SharingMessage(BaseMessage):
 
 
 class PictureMessage(BaseMessage):
-    image = models.ImageField(verbose_name='头像', upload_to="media/image/%Y/%m/%d")
+    image = models.ImageField(verbose_name='头像', upload_to="media/image/%Y/%m/%d", storage=cas_storage)
     img_height = models.IntegerField(verbose_name='图片高度', null=True)
     img_width = models.IntegerField(verbose_name='图片宽度', null=True)
 
@@ -267,7 +338,7 @@ class PictureMessage(BaseMessage):
 
 class RecordingMessage(BaseMessage):
     voice_length = models.BigIntegerField(null=True, verbose_name='录音时间')
-    record = models.FileField(upload_to='media/record/%Y/%m/%d')
+    record = models.FileField(upload_to='media/record/%Y/%m/%d', storage=cas_storage)
 
     class Meta:
         verbose_name = verbose_name_plural = '录音消息'
@@ -275,7 +346,7 @@ class RecordingMessage(BaseMessage):
 
 class AttachmentMessage(BaseMessage):
     file_size = models.CharField(max_length=20, null=True)
-    file = models.FileField(max_length=500, upload_to='media/file/%Y/%m/%d')
+    file = models.FileField(max_length=500, upload_to='media/file/%Y/%m/%d', storage=cas_storage)
 
     class Meta:
         verbose_name = verbose_name_plural = '文件消息'
@@ -283,12 +354,26 @@ class AttachmentMessage(BaseMessage):
 
 class VideoMessage(BaseMessage):
     play_length = models.IntegerField(null=True)
-    video = models.FileField(upload_to='media/video/%Y/%m/%d')
+    video = models.FileField(upload_to='media/video/%Y/%m/%d', storage=cas_storage)
 
     class Meta:
         verbose_name = verbose_name_plural = '视频消息'
 
 
+class MediaBlob(models.Model):
+    """按内容保存的文件的引用计数"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='文件路径')
+    size = models.BigIntegerField(verbose_name='文件大小')
+    ref_count = models.IntegerField(default=0, verbose_name='引用次数')
+    create_time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = verbose_name_plural = '消息文件'
+
+    def __str__(self):
+        return self.name
+
+
 class CardMessage(BaseMessage):
     SEX_CHOICES = (
         (1, '男'),
@@ -1,26 +1,36 @@
 import os
-from io import BytesIO
 
-from django.db import transaction
+from django.conf import settings
+from django.db import transaction, IntegrityError
 from django.utils.functional import cached_property
 
 from django_redis import get_redis_connection
 
 from collections import OrderedDict
+from operator import attrgetter
 
 from wxpy import User, Group, MP
 
 from rest_framework import serializers
 
-from wechat.core.access_token import AccessToken
+from wechat.core.access_token import get_access_token_class
+from wechat.core.credentials import Credentials, ReplayWindow
 from wechat.core import exception
+from wechat.core.registry import bot_registry
+from wechat.core import runtime
+from wechat.core.contacts import get_contacts
+from wechat.core.media import media_downloader
+from wechat.core.storage import cas_storage
+from wechat.core.thumbnail import thumbnail_pipeline
+from wechat.core import parsers
+from wechat.core.metrics import metrics
 
 from . import models
 from .core import utils
 
 import time
 import hashlib
-import re
+import hmac
 
 
 class SignatureSerializer(serializers.Serializer):
@@ -28,11 +38,12 @@ class SignatureSerializer(serializers.Serializer):
     app_secret = serializers.CharField()
     timestamp = serializers.IntegerField()
     signature = serializers.CharField()
+    nonce = serializers.CharField(required=False)
 
     def validate_timestamp(self, attrs):
         """验证时间戳的合法性"""
         now = time.time()
-        if now - attrs > 3:
+        if abs(now - attrs) > ReplayWindow.window:
             raise serializers.ValidationError('invalid timestamp')
         return attrs
 
@@ -41,15 +52,20 @@ class SignatureSerializer(serializers.Serializer):
         signature = attrs.get('signature')
         app = self.get_app(attrs)
         # 验证签名的正确性
-        real_signature = self.get_real_signature(timestamp, app)
-        if real_signature != signature:
+        real_signature = self.get_real_signature(timestamp, app, attrs.get('nonce'))
+        if not hmac.compare_digest(real_signature.encode(), signature.encode()):
             raise serializers.ValidationError({'signature': 'invalid signature'})
+        # 同一个签名只能使用一次
+        if not ReplayWindow.check(app.app_id, signature):
+            raise serializers.ValidationError({'signature': 'signature has been used'})
         return app
 
-    def get_real_signature(self, timestamp: int, app: models.AppModel, ):
+    def get_real_signature(self, timestamp: int, app: models.AppModel, nonce=None):
         """获取真实的签名"""
         token = app.token
         item = [token, str(timestamp)]
+        if nonce:
+            item.append(nonce)
         item.sort()
         string = ''.join(item)
         return hashlib.sha1(string.encode()).hexdigest()
@@ -58,28 +74,30 @@ class SignatureSerializer(serializers.Serializer):
         app_id = attr.get('app_id')
         app_secret = attr.get('app_secret')
         try:
-            app = models.AppModel.objects.get(app_id=app_id, app_secret=app_secret)
-        except models.AppModel.DoesNotExist:
+            app = Credentials.get_app(app_id, app_secret)
+        except exception.AppDoesNotExistException:
             raise serializers.ValidationError({'app_id': 'invalid appid'})
         return app
 
 
 class CheckLoginSerializer(serializers.Serializer):
     uuid = serializers.CharField()
+    # 长轮询: 传入上一次拿到的`status`和等待的秒数,状态变化或超时才返回
+    status = serializers.CharField(required=False)
+    wait = serializers.IntegerField(required=False, min_value=0)
+
+    max_wait = getattr(settings, 'CHECK_LOGIN_MAX_WAIT', 30)
 
     def validate(self, attrs):
         uuid = attrs.get('uuid')
         coon = get_redis_connection('default')
-
-        response = OrderedDict()
-
-        response['status'] = coon.hget(uuid, 'status')
         request = self.context.get('request')
-        response['avatar'] = coon.hget(uuid, 'avatar')
-        key = f'{request.auth.app_id}_alive'
-        response['alive'] = coon.get(key)
+        app_id = request.auth.app_id
 
-        return response
+        wait = min(attrs.get('wait') or 0, self.max_wait)
+        if wait and 'status' in attrs:
+            return utils.wait_login_state(coon, uuid, app_id, attrs['status'], wait)
+        return utils.get_login_state(coon, uuid, app_id)
 
 
 class WxUserModelModelSerializer(serializers.ModelSerializer):
@@ -114,6 +132,32 @@ class WxMpsModelModelSerializer(serializers.ModelSerializer):
 
 
 class BaseModelSerializer(serializers.ModelSerializer):
+    # `(字段名, get_<字段名>_attr方法, 属性获取函数)`的列表,每个类只编译一次
+    _extraction_plan = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 子类可能重写了`get_<字段名>_attr`,不能用父类的
+        cls._extraction_plan = None
+
+    @classmethod
+    def get_extraction_plan(cls):
+        if cls._extraction_plan is None:
+            # 字段依赖模型的元数据,在第一次使用时才编译
+            cls._extraction_plan = cls.compile_extraction_plan()
+        return cls._extraction_plan
+
+    @classmethod
+    def compile_extraction_plan(cls):
+        plan = []
+        for field in cls().fields.values():
+            if field.write_only:
+                continue
+            field_name = field.field_name
+            # 先判断有没有自己实现获取属性的方法,没有时从`instance`中根据属性名获取
+            handle = getattr(cls, f'get_{field_name}_attr', None)
+            plan.append((field_name, handle, None if handle else attrgetter(field_name)))
+        return tuple(plan)
 
     def to_representation(self, instance):
         """将message对象转换为dict对象"""
@@ -124,28 +168,14 @@ class BaseModelSerializer(serializers.ModelSerializer):
     @transaction.atomic
     def to_message_representation(self, instance):
         ret = OrderedDict()
-        # 获取所有的字段
-        fields = self._readable_fields
-
-        save_point = transaction.savepoint()
-
-        for field in fields:
-            field_name = field.field_name
-
-            # 先判断有没有自己实现获取属性的方法
-            if hasattr(self, f'get_{field_name}_attr'):
-                handle = getattr(self, f'get_{field_name}_attr')
-                ret = handle(ret)
+        for field_name, handle, getter in self.get_extraction_plan():
+            if handle is not None:
+                ret = handle(self, ret)
                 continue
-
-            # 尝试从`instance`中根据属性名获取属性值
             try:
-                value = getattr(instance, field_name)
-                ret[field_name] = value
+                ret[field_name] = getter(instance)
             except AttributeError:
-                transaction.savepoint_rollback(save_point)
                 raise AttributeError(f'`instance`没有{field_name}这个属性,你可以定义`get_{field_name}_attr`来获取对应的值')
-
         return ret
 
     @property
@@ -155,15 +185,42 @@ class BaseModelSerializer(serializers.ModelSerializer):
     def message_create(self, data):
         return self.model.objects.create(**data)
 
+    def message_build(self, data):
+        """只创建模型对象,不写入数据库,用于批量写入"""
+        return self.model(**data)
+
+    def message_saved(self, obj):
+        """消息和文件都写入数据库之后调用"""
+        pass
+
+    def message_discarded(self, obj):
+        """`message_build`创建的对象没有写入数据库(比如重复的消息)时调用"""
+        pass
+
 
 class BaseMessageSerializer(BaseModelSerializer):
     def get_message_attr(self, ret):
-        data = self.serializer.data
-        data.update(self.get_extra_field())
-        message = self.serializer.message_create(data)
+        # 主要是获取联系人对应的模型对象
+        with metrics.timer('contacts', self.instance.type):
+            data = self.serializer.data
+            data.update(self.get_extra_field())
+        # 先不写入数据库,和具体类型的消息一起保存
+        message = self.serializer.message_build(data)
         ret['message'] = message
         return ret
 
+    def message_create(self, data):
+        message = data['message']
+        try:
+            with transaction.atomic():
+                message.save(force_insert=True)
+                return super().message_create(data)
+        except IntegrityError:
+            # 已经保存过的消息直接忽略
+            if models.MessageModel.objects.filter(pk=message.pk).exists():
+                raise exception.DuplicateMessageException(f'消息{message.pk}已经保存过了')
+            raise
+
     @cached_property
     def serializer(self):
         return MessageModelSerializer(self.instance)
@@ -183,25 +240,30 @@ class MessageModelSerializer(BaseModelSerializer):
         model = models.MessageModel
         exclude = ['sender_content_type', 'sender_puid', 'receiver_content_type', 'receiver_puid']
 
+    @cached_property
+    def contacts(self):
+        """bot的联系人缓存,避免每条消息都查询数据库"""
+        return get_contacts(self.instance.bot)
+
     def get_member_attr(self, ret):
         """获取member"""
         member = self.instance.member
-        ret['member'] = models.WxUserModel.get_user(self.instance.member) if member else None
+        ret['member'] = self.contacts.get_user(member) if member else None
         return ret
 
     def get_owner_attr(self, ret):
         """获取owner"""
-        ret['owner'] = models.WxUserModel.get_user(self.instance.bot.self)
+        ret['owner'] = self.contacts.get_user(self.instance.bot.self)
         return ret
 
     def get_sender_attr(self, ret):
         """获取sender"""
-        ret['sender'] = self.get_msg_relater(self.instance.sender)
+        ret['sender'] = self.contacts.get_relater(self.instance.sender)
         return ret
 
     def get_receiver_attr(self, ret):
         """获取receiver"""
-        ret['receiver'] = self.get_msg_relater(self.instance.receiver)
+        ret['receiver'] = self.contacts.get_relater(self.instance.receiver)
         return ret
 
     @staticmethod
@@ -230,36 +292,42 @@ class MapMessageModelSerializer(BaseMessageSerializer):
         fields = '__all__'
 
     def get_x_attr(self, ret):
-        ret['x'] = self.location.get('x')
+        ret['x'] = self.location.x
         return ret
 
     def get_y_attr(self, ret):
-        ret['y'] = self.location.get('y')
+        ret['y'] = self.location.y
         return ret
 
     def get_scale_attr(self, ret):
-        ret['scale'] = self.location.get('scale')
+        ret['scale'] = self.location.scale
         return ret
 
     def get_label_attr(self, ret):
-        ret['label'] = self.location.get('label')
+        ret['label'] = self.location.label
         return ret
 
     def get_maptype_attr(self, ret):
-        ret['maptype'] = self.location.get('maptype')
+        ret['maptype'] = self.location.maptype
         return ret
 
     def get_poiname_attr(self, ret):
-        ret['poiname'] = self.location.get('poiname')
+        ret['poiname'] = self.location.poiname
         return ret
 
     def get_poiid_attr(self, ret):
-        ret['poiid'] = self.location.get('poiid')
+        ret['poiid'] = self.location.poiid
+        return ret
+
+    def get_text_attr(self, ret):
+        # 和`wxpy`一样,优先使用位置的描述
+        ret['text'] = self.location.label or self.instance.raw.get('Text') or ''
         return ret
 
     @cached_property
     def location(self):
-        return self.instance.location
+        raw = self.instance.raw
+        return parsers.parse_map(raw.get('OriContent') or raw.get('Content'))
 
 
 class SharingMessageModelSerializer(BaseMessageSerializer):
@@ -267,71 +335,111 @@ class SharingMessageModelSerializer(BaseMessageSerializer):
         model = models.SharingMessage
         fields = '__all__'
 
+    def get_url_attr(self, ret):
+        ret['url'] = self.instance.url or self.sharing.url
+        return ret
+
+    def get_text_attr(self, ret):
+        # 标题可能比`text`字段长
+        max_length = models.SharingMessage._meta.get_field('text').max_length
+        ret['text'] = (self.instance.text or self.sharing.title or '')[:max_length]
+        return ret
+
+    @cached_property
+    def sharing(self):
+        return parsers.parse_sharing(self.instance.raw.get('Content'))
+
+
+class MediaMessageSerializer(BaseMessageSerializer):
+    """带文件的消息,文件分块下载到临时文件后再写入存储,不会整个读进内存"""
+    # 保存文件的字段名
+    media_field = None
+
+    def get_media_attr(self, ret):
+        try:
+            with metrics.timer('media', self.instance.type):
+                ret[self.media_field] = media_downloader.download(self.instance)
+        except exception.MediaTooLargeException as e:
+            # 文件太大时只保存消息,不保存文件
+            print(e.__str__())
+            ret[self.media_field] = None
+        return ret
+
+    def message_create(self, data):
+        file = data.pop(self.media_field)
+        try:
+            obj = super().message_create(data)
+        except Exception:
+            if file is not None:
+                file.close()
+            raise
+        return self.save_media(obj, file, save=True)
+
+    def message_build(self, data):
+        file = data.pop(self.media_field)
+        obj = super().message_build(data)
+        return self.save_media(obj, file, save=False)
+
+    def message_discarded(self, obj):
+        # 文件已经写入存储,减少引用
+        cas_storage.release(getattr(obj, self.media_field).name)
+
+    def save_media(self, obj, file, save):
+        if file is None:
+            return obj
+        try:
+            getattr(obj, self.media_field).save(name=os.path.basename(file.name), content=file, save=save)
+        finally:
+            file.close()
+        return obj
+
+
+class PictureMessageModelSerializer(MediaMessageSerializer):
+    media_field = 'image'
 
-class PictureMessageModelSerializer(BaseMessageSerializer):
     class Meta:
         model = models.PictureMessage
         fields = '__all__'
 
     def get_image_attr(self, ret):
-        image = self.instance.get_file()
-        ret['image'] = image
-        return ret
+        return self.get_media_attr(ret)
+
+    def message_saved(self, obj):
+        # 事务提交后子进程才能看到文件,尺寸也才能更新到已经存在的行上
+        transaction.on_commit(lambda: thumbnail_pipeline.submit(obj))
 
-    def message_create(self, data):
-        image = data.pop('image')
-        obj = super().message_create(data)
-        obj.image.save(name=self.instance.file_name, content=BytesIO(image))
-        return obj
 
+class RecordingMessageModelSerializer(MediaMessageSerializer):
+    media_field = 'record'
 
-class RecordingMessageModelSerializer(BaseMessageSerializer):
     class Meta:
         model = models.RecordingMessage
         fields = '__all__'
 
     def get_record_attr(self, ret):
-        record = self.instance.get_file()
-        ret['record'] = record
-        return ret
+        return self.get_media_attr(ret)
 
-    def message_create(self, data):
-        record = data.pop('record')
-        obj = super().message_create(data)
-        obj.record.save(name=self.instance.file_name, content=BytesIO(record))
-        return obj
 
+class VideoMessageModelSerializer(MediaMessageSerializer):
+    media_field = 'video'
 
-class VideoMessageModelSerializer(BaseMessageSerializer):
     class Meta:
         model = models.VideoMessage
         fields = '__all__'
 
     def get_video_attr(self, ret):
-        ret['video'] = self.instance.get_file()
-        return ret
+        return self.get_media_attr(ret)
 
-    def message_create(self, data):
-        video = data.pop('video')
-        obj = super().message_create(data)
-        obj.video.save(name=self.instance.file_name, content=BytesIO(video))
-        return obj
 
+class AttachmentMessageModelSerializer(MediaMessageSerializer):
+    media_field = 'file'
 
-class AttachmentMessageModelSerializer(BaseMessageSerializer):
     class Meta:
         model = models.AttachmentMessage
         fields = '__all__'
 
     def get_file_attr(self, ret):
-        ret['file'] = self.instance.get_file()
-        return ret
-
-    def message_create(self, data):
-        file = data.pop('file')
-        obj = super().message_create(data)
-        obj.file.save(name=self.instance.file_name, content=BytesIO(file))
-        return obj
+        return self.get_media_attr(ret)
 
 
 class CardMessageModelSerializer(BaseMessageSerializer):
@@ -340,60 +448,41 @@ class CardMessageModelSerializer(BaseMessageSerializer):
         fields = '__all__'
 
     @cached_property
-    def raw_content(self):
-        return self.instance.raw.get('Content')
+    def card(self):
+        return parsers.parse_card(self.instance.raw.get('Content'))
 
     def get_username_attr(self, ret):
-        username = self.re_search('username')
-        ret['username'] = username
+        ret['username'] = self.card.username
         return ret
 
     def get_nickname_attr(self, ret):
-        nickname = self.re_search('nickname')
-        ret['nickname'] = nickname
+        ret['nickname'] = self.card.nickname
         return ret
 
     def get_alias_attr(self, ret):
-        alias = self.re_search('alias')
-        ret['alias'] = alias
+        ret['alias'] = self.card.alias
         return ret
 
     def get_province_attr(self, ret):
-        province = self.re_search('province')
-        ret['province'] = province
+        ret['province'] = self.card.province
         return ret
 
     def get_city_attr(self, ret):
-        city = self.re_search('city')
-        ret['city'] = city
+        ret['city'] = self.card.city
         return ret
 
     def get_sign_attr(self, ret):
-        sign = self.re_search('sign')
-        ret['sign'] = sign
+        ret['sign'] = self.card.sign
         return ret
 
     def get_sex_attr(self, ret):
-        sex = self.re_search('sex')
-        ret['sex'] = sex
+        ret['sex'] = self.card.sex
         return ret
 
     def get_avatar_attr(self, ret):
-        avatar = self.re_search('bigheadimgurl')
-        ret['avatar'] = avatar
+        ret['avatar'] = self.card.avatar
         return ret
 
-    def re_search(self, attr=None, reg=None, extract_first=True):
-        """正则匹配xml"""
-        assert any([attr, reg]), '`attr` 和 `reg` 必须有一个为必填参数!'
-        if attr:
-            reg = f'{attr}="(.*?)"'
-            result = re.findall(reg, self.raw_content)
-            return result[0] if extract_first else result
-
-        result = re.findall(reg, self.raw_content)
-        return result[0] if extract_first else result
-
 
 class NoteMessageModelSerializer(BaseMessageSerializer):
     class Meta:
@@ -404,6 +493,7 @@ class NoteMessageModelSerializer(BaseMessageSerializer):
 class MessageReadModelSerializer(serializers.ModelSerializer):
     content = serializers.SerializerMethodField()
     type = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = models.MessageModel
@@ -445,6 +535,20 @@ class MessageReadModelSerializer(serializers.ModelSerializer):
             'receiver': row.receiver.__class__.__name__.lower()
         }
 
+    def get_thumbnails(self, row):
+        """图片消息的缩略图地址,缩略图还没有生成时返回None"""
+        if row.type != 'Picture':
+            return None
+        picture = row.picturemessage
+        if not picture.image or picture.img_width is None:
+            return None
+        request = self.context.get('request')
+        thumbnails = OrderedDict()
+        for size, name in thumbnail_pipeline.get_thumbnails(picture.image.name).items():
+            url = picture.image.storage.url(name)
+            thumbnails[size] = request.build_absolute_uri(url) if request is not None else url
+        return thumbnails
+
     def get_serializers_class(self, msg_type):
         return self.Meta.serializers_class_route.get(msg_type)
 
@@ -459,11 +563,12 @@ class AccessTokenSerializer(serializers.Serializer):
     def validate(self, attrs):
         app_id = attrs.get('app_id')
         app_secret = attrs.get('app_secret')
+        access_token_class = get_access_token_class()
         try:
-            token = AccessToken.create_access_token(app_id, app_secret)
+            token = access_token_class.create_access_token(app_id, app_secret)
         except exception.AppDoesNotExistException:
             raise serializers.ValidationError({'errmsg': '无效的app'})
-        return {'access_token': token, 'expire_in': AccessToken.expire_in}
+        return {'access_token': token, 'expire_in': access_token_class.expire_in}
 
 
 class SendMessageSerializer(serializers.Serializer):
@@ -483,7 +588,8 @@ class SendMessageSerializer(serializers.Serializer):
 
     def validate_file(self, attr):
         if attr:
-            file_name = f'{time.time()}{attr.name}'
+            # 使用绝对路径,bot运行在独立进程时也能找到文件
+            file_name = os.path.abspath(f'{time.time()}{attr.name}')
             with open(file_name, 'wb') as f:
                 for line in attr.chunks():
                     f.write(line)
@@ -498,12 +604,15 @@ class SendMessageSerializer(serializers.Serializer):
         puid = attrs.get('puid')
         # 检测数据的合法性
         self.validate_file_and_text(attrs)
+        data = {'msg_type': msg_type, 'puid': puid, 'text': text, 'file_path': file}
+        # bot运行在独立进程时由bot进程检验在线状态
+        if runtime.ENABLED:
+            return data
         # 检验在线状态
         try:
-            bot = utils.get_cache_bot(self.request)
+            data['bot'] = utils.get_cache_bot(self.request)
         except AssertionError as e:
             raise serializers.ValidationError({'errmsg': e.__str__()})
-        data = {'bot': bot, 'msg_type': msg_type, 'puid': puid, 'text': text, 'file_path': file}
 
         return data
 
@@ -519,13 +628,22 @@ class SendMessageSerializer(serializers.Serializer):
     def create(self, validated_data):
         """尝试发消息,如果不成功,则抛出异常,最后删除文件"""
         try:
-            msg = utils.send_message(**validated_data)
+            if runtime.ENABLED:
+                # 由bot进程发送并保存消息
+                response = runtime.runtime_client.call(self.request.auth.app_id, 'send', **validated_data)
+                setattr(self, 'response', response)
+                return response
+            # 同一个微信号的发送操作串行执行
+            with bot_registry.lock(self.request.auth.app_id):
+                msg = utils.send_message(**validated_data)
         except exception.PUIDSearchError:
             raise serializers.ValidationError({'errmsg': '未找到对应uuid的匹配对象!'})
+        except exception.BotRuntimeException as e:
+            raise serializers.ValidationError({'errmsg': e.__str__()})
         finally:
-            # 删除文件
+            # 删除文件,bot运行在独立进程时由bot进程删除
             file_path = validated_data.pop('file_path')
-            if file_path:
+            if file_path and not runtime.ENABLED:
                 os.remove(file_path)
         return self.save_message(msg)
 
@@ -547,6 +665,7 @@ class SendMessageSerializer(serializers.Serializer):
         msg = SendMessageParser(msg, context)
         serializer = msg.get_serializer()
         msg_model_obj = serializer.message_create(serializer.data)
+        serializer.message_saved(msg_model_obj)
         message_serializer = MessageReadModelSerializer(msg_model_obj.message)
         response = message_serializer.data
         setattr(self, 'response', response)
@@ -0,0 +1,36 @@
+from django.db.models.signals import post_save, post_delete
+from django.db.models import FileField
+from django.dispatch import receiver
+
+from wechat.core.cache import invalidator
+from wechat.core.storage import cas_storage
+from wechat.core.thumbnail import thumbnail_pipeline
+
+from . import models
+
+
+@receiver([post_save, post_delete], sender=models.AppModel)
+def invalidate_app_cache(sender, instance, **kwargs):
+    """app发生变化后,通知所有进程删除app相关的缓存"""
+    if instance.app_id:
+        invalidator.publish('app', instance.app_id)
+
+
+@receiver([post_save, post_delete], sender=models.MessageRouteModel)
+def invalidate_route_cache(sender, instance, **kwargs):
+    """路由发生变化后,通知所有进程重新加载app的路由表"""
+    invalidator.publish('route', instance.app.app_id)
+
+
+@receiver(post_delete, sender=models.PictureMessage)
+@receiver(post_delete, sender=models.RecordingMessage)
+@receiver(post_delete, sender=models.AttachmentMessage)
+@receiver(post_delete, sender=models.VideoMessage)
+def release_media(sender, instance, **kwargs):
+    """删除消息后减少文件的引用,没有引用的文件会被删除"""
+    for field in sender._meta.get_fields():
+        if not isinstance(field, FileField):
+            continue
+        name = getattr(instance, field.name).name
+        if cas_storage.release(name) and sender is models.PictureMessage:
+            thumbnail_pipeline.delete(name)
@@ -1,6 +1,85 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+
+from wechat.core.parsers import parse_card, parse_map, parse_sharing
 
 
 # Create your tests here.
 
 
+class ParseCardTestCase(SimpleTestCase):
+
+    def test_escaped_content(self):
+        content = ('&lt;?xml version="1.0"?&gt;&lt;msg bigheadimgurl="http://a.com/1.jpg?a=1&amp;amp;b=2" '
+                   'username="wxid_abc" nickname="Tom &amp;amp; Jerry" sex="1" province="广东" city="深圳" /&gt;')
+        card = parse_card(content)
+        self.assertEqual(card.username, 'wxid_abc')
+        self.assertEqual(card.nickname, 'Tom & Jerry')
+        self.assertEqual(card.avatar, 'http://a.com/1.jpg?a=1&b=2')
+        self.assertEqual(card.sex, 1)
+        self.assertEqual(card.city, '深圳')
+
+    def test_missing_attributes(self):
+        card = parse_card('<msg username="wxid_abc" />')
+        self.assertEqual(card.username, 'wxid_abc')
+        self.assertEqual(card.nickname, '')
+        self.assertEqual(card.avatar, '')
+        self.assertIsNone(card.sex)
+
+    def test_empty_content(self):
+        for content in (None, ''):
+            card = parse_card(content)
+            self.assertEqual(card.username, '')
+            self.assertIsNone(card.sex)
+
+
+class ParseMapTestCase(SimpleTestCase):
+
+    def test_location(self):
+        content = ('<msg><location x="22.543" y="114.057" scale="16" label="深圳市&amp;南山区" maptype="0" '
+                   'poiname="[位置]" poiid="" /></msg>')
+        location = parse_map(content)
+        self.assertEqual(location.x, 22.543)
+        self.assertEqual(location.y, 114.057)
+        self.assertEqual(location.scale, 16)
+        self.assertEqual(location.label, '深圳市&南山区')
+        self.assertEqual(location.poiname, '[位置]')
+
+    def test_missing_and_invalid_numbers(self):
+        # 位置消息表的数字字段不能为空,缺少或者不是数字时为0
+        location = parse_map('<msg><location x="" scale="abc" label="a" /></msg>')
+        self.assertEqual(location.x, 0.0)
+        self.assertEqual(location.y, 0.0)
+        self.assertEqual(location.scale, 0)
+        self.assertEqual(location.maptype, 0)
+        self.assertEqual(location.poiid, '')
+
+    def test_empty_content(self):
+        location = parse_map(None)
+        self.assertEqual((location.x, location.y, location.label), (0.0, 0.0, ''))
+
+
+class ParseSharingTestCase(SimpleTestCase):
+
+    def test_cdata(self):
+        content = ('<msg><appmsg><title><![CDATA[标题 <b>]]></title><des><![CDATA[描述]]></des>'
+                   '<type>5</type><url><![CDATA[http://a.com/?a=1&b=2]]></url>'
+                   '<appinfo><title>其他标题</title></appinfo></appmsg></msg>')
+        sharing = parse_sharing(content)
+        self.assertEqual(sharing.title, '标题 <b>')
+        self.assertEqual(sharing.description, '描述')
+        self.assertEqual(sharing.url, 'http://a.com/?a=1&b=2')
+        self.assertEqual(sharing.app_type, 5)
+
+    def test_escaped_content(self):
+        content = '&lt;msg&gt;&lt;appmsg&gt;&lt;title&gt; 标题 &lt;/title&gt;&lt;url&gt;http://a.com/?a=1&amp;amp;b=2' \
+                  '&lt;/url&gt;&lt;/appmsg&gt;&lt;/msg&gt;'
+        sharing = parse_sharing(content)
+        self.assertEqual(sharing.title, '标题')
+        self.assertEqual(sharing.url, 'http://a.com/?a=1&b=2')
+
+    def test_missing_elements(self):
+        sharing = parse_sharing('<msg><appmsg><title>标题</title></appmsg></msg>')
+        self.assertEqual(sharing.title, '标题')
+        self.assertEqual(sharing.description, '')
+        self.assertEqual(sharing.url, '')
+        self.assertIsNone(sharing.app_type)
@@ -19,8 +19,10 @@ urlpatterns = [
     re_path('^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_PATH}),
     path('login', views.LoginView.as_view()),
     path('check-login', views.CheckLoginView.as_view()),
+    path('check-login/stream', views.CheckLoginStreamView.as_view()),
     path('access-token', views.AccessTokenView.as_view()),
     path('update', views.UpdateUserInfoView.as_view()),
+    path('metrics', views.MetricsView.as_view()),
 ]
 
 urlpatterns += route.urls
@@ -1,3 +1,6 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse, HttpResponse, Http404
+
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet, GenericViewSet
@@ -6,13 +9,17 @@ from rest_framework.mixins import RetrieveModelMixin, CreateModelMixin
 from django_redis import get_redis_connection
 
 from wechat.core.bot import SaveModelMessageBot
-from wechat.core.authentication import AccessTokenAuthentication
+from wechat.core.authentication import AccessTokenAuthentication, MetricsAuthentication
 from wechat.core import pkl_path
+from wechat.core.login import login_manager
+from wechat.core.metrics import metrics
+from wechat.core import runtime
+from wechat.core import exception
 
 from wechat import serializers, models
 from wechat.core import utils
 
-import threading
+import json
 import time
 import os
 
@@ -22,36 +29,58 @@ class LoginView(APIView):
 
     authentication_classes = [AccessTokenAuthentication]
 
+    # 等待二维码生成的最长时间
+    qrcode_timeout = getattr(settings, 'LOGIN_QRCODE_TIMEOUT', 30)
+
     def get(self, request, *args, **kwargs):
         assert self.bot_class is not None, 'bot_class不能为`None`'
-        # 创建线程
-        flag = time.time()
-        login = threading.Thread(target=self.bot_login, args=(flag,))
-        login.start()
-        # 递归获取二维码
+        # 提交登录任务,同一个app重复请求时拿到的是正在进行的登录的二维码
+        try:
+            flag = self.submit_login(time.time())
+        except exception.BotRuntimeException as e:
+            return Response({'errmsg': e.__str__()}, status=503)
+        # 阻塞等待二维码
         response = self.get_response(flag)
+        if not response:
+            self.abandon_login(flag)
+            return Response({'errmsg': '获取二维码超时!'}, status=504)
         # byte 转字符串
         response = {k.decode(): v.decode() for k, v in response.items()}
-        # 将键名改过来,便于登陆查询
-        self.rename_redis_key(flag)
         return Response(response)
 
+    def submit_login(self, flag):
+        app_id = self.request.auth.app_id
+        if runtime.ENABLED:
+            bot_class = f'{self.bot_class.__module__}.{self.bot_class.__qualname__}'
+            return runtime.runtime_client.call(app_id, 'login', flag=flag, bot_class=bot_class)['flag']
+        flag, _ = login_manager.submit(app_id, self.bot_login, flag)
+        return flag
+
+    def abandon_login(self, flag):
+        """二维码超时后放弃这次登录,下一次请求会重新登录"""
+        app_id = self.request.auth.app_id
+        if runtime.ENABLED:
+            try:
+                runtime.runtime_client.call(app_id, 'abandon_login', flag=flag)
+            except exception.BotRuntimeException as e:
+                print(f'{app_id}放弃登录失败: {e.args}')
+            return
+        login_manager.abandon(app_id, flag)
+
     def bot_login(self, flag):
         obj = self.bot_class(request=self.request, flag=flag)
         # 永久存储puid
         obj.enable_puid(os.path.join(pkl_path, f'{self.request.auth.app_id}.pkl'))
 
     def get_response(self, flag):
-        time.sleep(0.01)
+        """等待`login_init`通知二维码已经生成,超时返回None"""
         coon = get_redis_connection('default')
-        qrcode = coon.hgetall(flag)
-        return qrcode if qrcode else self.get_response(flag)
-
-    @staticmethod
-    def rename_redis_key(flag):
-        coon = get_redis_connection('default')
-        uuid = coon.hget(flag, 'uuid')
-        coon.rename(flag, uuid)
+        ready_key = utils.get_qrcode_ready_key(flag)
+        # 取出uuid后再放回去,其他等待同一个二维码的请求也可以拿到
+        uuid = coon.brpoplpush(ready_key, ready_key, timeout=max(int(self.qrcode_timeout), 1))
+        if uuid is None:
+            return None
+        return coon.hgetall(uuid)
 
 
 class CheckLoginView(APIView):
@@ -64,6 +93,33 @@ class CheckLoginView(APIView):
         return Response(serializer.validated_data)
 
 
+class CheckLoginStreamView(APIView):
+    """以server-sent events的方式推送登陆状态的变化"""
+    authentication_classes = [AccessTokenAuthentication]
+
+    # 连接保持的最长时间
+    stream_timeout = getattr(settings, 'CHECK_LOGIN_STREAM_TIMEOUT', 300)
+
+    def get(self, request, *args, **kwargs):
+        uuid = request.GET.get('uuid')
+        if not uuid:
+            return Response({'errmsg': 'uuid为必填参数!'}, status=400)
+        response = StreamingHttpResponse(self.stream(uuid), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream(self, uuid):
+        coon = get_redis_connection('default')
+        for state in utils.iter_login_state(coon, uuid, self.request.auth.app_id, self.stream_timeout):
+            if state is None:
+                # 心跳,防止连接被代理断开
+                yield ': keep-alive\n\n'
+                continue
+            data = {k: v.decode() if v is not None else v for k, v in state.items()}
+            yield f'event: status\ndata: {json.dumps(data)}\n\n'
+
+
 class FriendsReadOnlyModelViewSet(ReadOnlyModelViewSet):
     """好友列表查询接口"""
     serializer_class = serializers.WxUserModelModelSerializer
@@ -154,7 +210,21 @@ class UpdateUserInfoView(APIView):
 
     def get(self, request, *args, **kwargs):
         try:
-            utils.update_app_info_by_view(request)
-        except AssertionError as e:
+            if runtime.ENABLED:
+                runtime.runtime_client.call(request.auth.app_id, 'update')
+            else:
+                utils.update_app_info_by_view(request)
+        except (AssertionError, exception.BotRuntimeException) as e:
             return Response({'errmsg': e.__str__()})
         return Response({'msg': '更新成功!'}, status=201)
+
+
+class MetricsView(APIView):
+    """消息处理各阶段的耗时和各组件的统计,Prometheus的文本格式"""
+    authentication_classes = [MetricsAuthentication]
+    permission_classes = []
+
+    def get(self, request, *args, **kwargs):
+        if not metrics.enabled:
+            raise Http404
+        return HttpResponse(metrics.export(), content_type='text/plain; version=0.0.4; charset=utf-8')